@@ -0,0 +1,65 @@
+"""
+Compare the shared prime sieve against the trial division it replaced.
+
+For each bound, times building the sieve up to it and then looking up a
+random sample of counts below it, against trial division on the same sample.
+
+    python benchmarks/bench_primes.py [--max 10000000] [--lookups 100000]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from primes import PrimeSieve
+
+def trial_division_is_prime(n: int) -> bool:
+    """The is_prime() that celebrate_twin_primes used to call"""
+    if n < 2:
+        return False
+    if n in (2, 3):
+        return True
+    if n % 2 == 0 or n % 3 == 0:
+        return False
+    i = 5
+    while i * i <= n:
+        if n % i == 0 or n % (i + 2) == 0:
+            return False
+        i += 6
+    return True
+
+def time_lookups(is_prime, numbers: list[int]) -> float:
+    start = time.perf_counter()
+    for n in numbers:
+        is_prime(n)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--max", type=int, default=10**7, help="largest count to test")
+    parser.add_argument("--lookups", type=int, default=100_000, help="random lookups per bound")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'bound':>12} {'sieve build':>12} {'sieve lookups':>14} {'trial division':>15} {'speedup':>8}")
+
+    bound = 1000
+    while bound <= args.max:
+        numbers = [rng.randrange(bound) for _ in range(args.lookups)]
+
+        start = time.perf_counter()
+        sieve = PrimeSieve(bound)
+        build = time.perf_counter() - start
+
+        sieve_time = time_lookups(sieve.is_prime, numbers)
+        trial_time = time_lookups(trial_division_is_prime, numbers)
+
+        print(f"{bound:>12} {build:>11.4f}s {sieve_time:>13.4f}s {trial_time:>14.4f}s {trial_time / sieve_time:>7.1f}x")
+        bound *= 10
+
+if __name__ == "__main__":
+    main()
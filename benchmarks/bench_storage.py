@@ -0,0 +1,166 @@
+"""
+Time the storage operations behind each request on synthetic data trees.
+
+For every combination of --users and --events-per-user a tree is generated
+with gen_data.py (optionally migrated into another engine with --storage)
+and these are timed:
+
+    init_user                    making sure a known user exists, before every write
+    count_lines_in_file          one user's drink count (Storage.user_counts)
+    get_all_stats                building the counter index at startup, then one call
+    get_last_drink_info          one user's last drink (Storage.last_drink)
+    remove_last_line_from_file   undoing one drink (Storage.remove_last)
+    append_timestamp_to_file     recording one drink (Storage.append)
+
+With the text engine the Storage methods are thin wrappers around the
+functions of the same names, so the rows show how each one scales with the
+size of the data.
+
+    python benchmarks/bench_storage.py --users 100,1000 --events-per-user 100,1000,10000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# Keep main.py's locks and journal out of the current directory
+os.environ.setdefault("TEAPOT_STATE_DIR", tempfile.mkdtemp(prefix="teapot-bench-state-"))
+
+import main as teapot
+from gen_data import generate, username
+from storage import DRINKS, TextStorage
+
+OPERATIONS = [
+    "init_user",
+    "count_lines_in_file",
+    "get_all_stats (startup)",
+    "get_all_stats",
+    "get_last_drink_info",
+    "remove_last_line_from_file",
+    "append_timestamp_to_file",
+]
+
+def open_engine(backend: str, data_dir: Path):
+    if backend == "text":
+        return TextStorage(data_dir)
+    if backend == "sharded":
+        import sharded_storage
+        return sharded_storage.migrate_to_sharded(data_dir)
+    if backend == "binary":
+        import binary_storage
+        return binary_storage.convert_to_binary(data_dir, data_dir.parent / "bindata")
+    if backend == "eventlog":
+        import eventlog
+        eventlog.migrate_from_text(data_dir, data_dir.parent / "eventlog")
+        return eventlog.EventLogStorage(data_dir.parent / "eventlog")
+    if backend == "sqlite":
+        import sqlite_storage
+        sqlite_storage.migrate_from_text(data_dir, data_dir.parent / "teapot.db")
+        return sqlite_storage.SqliteStorage(data_dir.parent / "teapot.db")
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def time_calls(function, arguments: list) -> float:
+    """Median seconds per call"""
+    timings = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def last_timestamp(engine, username: str, drink_type: str):
+    timestamps = [timestamp for timestamp, drink in engine.iter_events(username) if drink == drink_type]
+    return timestamps[-1] if timestamps else None
+
+def bench_tree(engine, users: int, samples: int, rng: random.Random) -> dict:
+    sampled = [username(rng.randrange(users)) for _ in range(samples)]
+    drinks = [(user, rng.choice(DRINKS)) for user in sampled]
+    # Put back exactly what was undone, so the tree ends up unchanged
+    last_timestamps = [last_timestamp(engine, user, drink_type) for user, drink_type in drinks]
+
+    results = {}
+    results["init_user"] = time_calls(engine.init_user, [(user,) for user in sampled])
+    results["count_lines_in_file"] = time_calls(engine.user_counts, [(user,) for user in sampled])
+
+    teapot.storage = engine
+    start = time.perf_counter()
+    teapot.build_counter_index()
+    results["get_all_stats (startup)"] = time.perf_counter() - start
+    results["get_all_stats"] = time_calls(teapot.get_all_stats, [(user,) for user in sampled])
+
+    results["get_last_drink_info"] = time_calls(teapot.get_last_drink_info, [(user,) for user in sampled])
+
+    removes, appends = [], []
+    for (user, drink_type), timestamp in zip(drinks, last_timestamps):
+        if timestamp is None:
+            continue
+        start = time.perf_counter()
+        engine.remove_last(user, drink_type)
+        removes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        engine.append(user, drink_type, timestamp)
+        appends.append(time.perf_counter() - start)
+    results["remove_last_line_from_file"] = statistics.median(removes) if removes else None
+    results["append_timestamp_to_file"] = statistics.median(appends) if appends else None
+    return results
+
+def format_seconds(seconds) -> str:
+    if seconds is None:
+        return "-"
+    if seconds >= 1:
+        return f"{seconds:.2f}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds * 1e6:.1f}us"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", default="100,1000", help="comma separated user counts")
+    parser.add_argument("--events-per-user", default="100,1000", help="comma separated average drinks per user")
+    parser.add_argument("--storage", default="text", choices=["text", "sharded", "binary", "eventlog", "sqlite"])
+    parser.add_argument("--samples", type=int, default=200, help="calls timed per operation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="also write the results as JSON")
+    args = parser.parse_args()
+
+    grid = [(int(users), int(events))
+            for users in args.users.split(",")
+            for events in args.events_per_user.split(",")]
+    rng = random.Random(args.seed)
+    runs = []
+
+    for users, events in grid:
+        workdir = Path(tempfile.mkdtemp(prefix="teapot-bench-"))
+        try:
+            data_dir = workdir / "data"
+            start = time.perf_counter()
+            total = generate(data_dir, users, events, seed=args.seed)
+            print(f"{users} users x {events} drinks: generated {total} drinks in {time.perf_counter() - start:.1f}s")
+            engine = open_engine(args.storage, data_dir)
+            runs.append({"users": users, "events_per_user": events, "total_events": total,
+                         "seconds": bench_tree(engine, users, args.samples, rng)})
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nMedian time per call, {args.storage} storage")
+    headers = [f"{run['users']}x{run['events_per_user']}" for run in runs]
+    print(f"{'operation':<28}" + "".join(f"{header:>14}" for header in headers))
+    for operation in OPERATIONS:
+        print(f"{operation:<28}" + "".join(f"{format_seconds(run['seconds'][operation]):>14}" for run in runs))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"storage": args.storage, "samples": args.samples, "runs": runs}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Just enough of an MQTT 3.1.1 broker to stand in for mosquitto in benchmarks.
+
+It accepts connections, acknowledges CONNECT, SUBSCRIBE and PINGREQ, and
+counts the PUBLISH packets it receives, per topic.  Nothing is forwarded to subscribers.
+"""
+import socket
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 1, 2, 3, 8, 9, 12, 13, 14
+
+class FakeMqttBroker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+        self.host, self.port = self.sock.getsockname()
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.published = 0
+        self.published_by_topic: dict[str, int] = {}
+
+    def start(self):
+        threading.Thread(target=self.accept, name="fake-mqtt-broker", daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections += 1
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        self.sock.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "published": self.published,
+            }
+
+    def missing_topics(self, topics, timeout: float = 2.0) -> set[str]:
+        """Which of the topics nothing was published to, giving late packets a moment"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                missing = set(topics) - self.published_by_topic.keys()
+            if not missing or time.monotonic() >= deadline:
+                return missing
+            time.sleep(0.05)
+
+    @staticmethod
+    def read_exactly(conn, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("client went away")
+            data += chunk
+        return data
+
+    def read_packet(self, conn) -> tuple[int, int, bytes]:
+        header = self.read_exactly(conn, 1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self.read_exactly(conn, 1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, self.read_exactly(conn, length)
+
+    def serve(self, conn):
+        with conn:
+            try:
+                while True:
+                    packet_type, _, body = self.read_packet(conn)
+                    if packet_type == CONNECT:
+                        conn.sendall(bytes([CONNACK << 4, 2, 0, 0]))
+                    elif packet_type == PUBLISH:
+                        topic_length = int.from_bytes(body[:2], "big")
+                        topic = body[2:2 + topic_length].decode()
+                        with self.lock:
+                            self.published += 1
+                            self.published_by_topic[topic] = self.published_by_topic.get(topic, 0) + 1
+                    elif packet_type == SUBSCRIBE:
+                        # Grant QoS 0 for every topic filter
+                        packet_id = body[:2]
+                        filters = 0
+                        i = 2
+                        while i < len(body):
+                            i += 2 + int.from_bytes(body[i:i + 2], "big") + 1
+                            filters += 1
+                        conn.sendall(bytes([SUBACK << 4, 2 + filters]) + packet_id + bytes(filters))
+                    elif packet_type == PINGREQ:
+                        conn.sendall(bytes([PINGRESP << 4, 0]))
+                    elif packet_type == DISCONNECT:
+                        return
+            except (ConnectionError, OSError):
+                return
@@ -0,0 +1,95 @@
+"""
+Generate a synthetic data/ tree for benchmarking.
+
+Writes data/<user>/tea.txt and coffee.txt in the same format as the server,
+with drinks spread over the last --days days the way an office drinks them:
+more on weekdays than at weekends, mostly around the morning arrival, after
+lunch and mid-afternoon, and each user leaning towards tea or coffee.
+
+    python benchmarks/gen_data.py --users 1000 --events-per-user 2000 --output /tmp/data
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from storage import DRINKS
+
+# (mean hour, spread in hours, weight) of the daily drinking peaks
+DAILY_PEAKS = [(8.75, 0.75, 4), (10.5, 0.5, 2), (13.5, 0.75, 3), (15.5, 0.75, 2), (18.0, 1.5, 1)]
+WEEKEND_WEIGHT = 0.2
+
+def username(i: int) -> str:
+    return f"user{i:05d}"
+
+def day_weights(days: list[date]) -> list[float]:
+    return [WEEKEND_WEIGHT if day.weekday() >= 5 else 1.0 for day in days]
+
+def second_of_day(rng: random.Random) -> int:
+    mean, spread, _ = rng.choices(DAILY_PEAKS, [peak[2] for peak in DAILY_PEAKS])[0]
+    hour = min(max(rng.gauss(mean, spread), 0), 23.9997)
+    return int(hour * 3600)
+
+def user_timestamps(rng: random.Random, events: int, day_prefixes: list[str], weights: list[float]) -> dict[str, list[str]]:
+    """Sorted timestamp lines for one user, split by drink"""
+    tea_share = rng.betavariate(2, 2)
+    picked_days = sorted(rng.choices(range(len(day_prefixes)), weights, k=events))
+    drinks = {drink_type: [] for drink_type in DRINKS}
+
+    # Sort within each day so every file stays in time order
+    for day, seconds in group_by_day(picked_days, rng):
+        for second in sorted(seconds):
+            drink_type = "tea" if rng.random() < tea_share else "coffee"
+            hour, rest = divmod(second, 3600)
+            drinks[drink_type].append(f"{day_prefixes[day]}{hour:02d}:{rest // 60:02d}:{rest % 60:02d}Z\n")
+    return drinks
+
+def group_by_day(picked_days: list[int], rng: random.Random):
+    start = 0
+    while start < len(picked_days):
+        end = start
+        while end < len(picked_days) and picked_days[end] == picked_days[start]:
+            end += 1
+        yield picked_days[start], [second_of_day(rng) for _ in range(end - start)]
+        start = end
+
+def generate(root: Path, users: int, events_per_user: int, days: int = 730, seed: int = 0,
+             end: date = None) -> int:
+    """Write the tree under root and return how many drinks were written"""
+    rng = random.Random(seed)
+    end = end or date.today()
+    calendar = [end - timedelta(days=offset) for offset in range(days - 1, -1, -1)]
+    day_prefixes = [f"{day.isoformat()}T" for day in calendar]
+    weights = day_weights(calendar)
+
+    total = 0
+    for i in range(users):
+        # Heavy and light drinkers, averaging events_per_user
+        events = max(1, round(events_per_user * rng.uniform(0.5, 1.5)))
+        user_dir = Path(root) / username(i)
+        user_dir.mkdir(parents=True, exist_ok=True)
+        for drink_type, lines in user_timestamps(rng, events, day_prefixes, weights).items():
+            with open(user_dir / f"{drink_type}.txt", "w") as f:
+                f.write("".join(lines))
+        total += events
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--events-per-user", type=int, default=1000, help="average drinks per user")
+    parser.add_argument("--days", type=int, default=730, help="days of history, ending today")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=Path("synthetic_data"))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    total = generate(args.output, args.users, args.events_per_user, args.days, args.seed)
+    print(f"Wrote {total} drinks for {args.users} users to {args.output} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Load test for the API server.
+
+Runs main.py in-process against a throwaway working directory, with a local
+bare repository standing in for GitHub and a fake broker standing in for
+mosquitto, then has a number of simulated devices hit it concurrently with
+a mix of tea, coffee, undo and stats requests.  Throughput and latency
+percentiles per endpoint are printed and written to a JSON file, and a
+previous results file can be passed to compare against.
+
+    python benchmarks/load_test.py --devices 50 --duration 30 --output results.json
+    python benchmarks/load_test.py --compare results.json
+
+Needs httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, UTC
+from pathlib import Path
+
+import httpx
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_mqtt_broker import FakeMqttBroker
+
+# Relative weights of what a device does on each press
+DEFAULT_MIX = {"tea": 50, "coffee": 30, "undo": 5, "stats": 15}
+
+def git(*args: str, cwd: Path):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+def make_workdir(seed_data: Path | None) -> Path:
+    """A git working copy with a bare repo next to it as origin"""
+    root = Path(tempfile.mkdtemp(prefix="teapot-load-"))
+    remote = root / "remote.git"
+    work = root / "work"
+    work.mkdir()
+
+    git("init", "--bare", "-b", "main", str(remote), cwd=root)
+    git("init", "-b", "main", cwd=work)
+    git("config", "user.name", "Load Test", cwd=work)
+    git("config", "user.email", "load-test@localhost", cwd=work)
+    git("remote", "add", "origin", str(remote), cwd=work)
+
+    (work / "data").mkdir()
+    if seed_data:
+        shutil.copytree(seed_data, work / "data", dirs_exist_ok=True)
+    (work / "README").write_text("load test\n")
+    git("add", ".", cwd=work)
+    git("commit", "-m", "Initial commit", cwd=work)
+    git("push", "origin", "main", cwd=work)
+    return work
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarise(samples: list[tuple[float, int]], duration: float) -> dict:
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    return {
+        "count": len(samples),
+        "errors": sum(1 for _, status in samples if status >= 400),
+        "throughput_rps": round(len(samples) / duration, 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0,
+    }
+
+async def device(client: httpx.AsyncClient, username: str, mix: dict, deadline: float,
+                 think_time: float, rng: random.Random, samples: dict):
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+    while time.monotonic() < deadline:
+        action = rng.choices(actions, weights)[0]
+        if action == "stats":
+            label, request = "GET /stats/{username}", client.get(f"/stats/{username}")
+        else:
+            label, request = f"POST /{{username}}/{action}", client.post(f"/{username}/{action}")
+
+        start = time.perf_counter()
+        try:
+            response = await request
+            status = response.status_code
+        except Exception:
+            status = 599
+        samples.setdefault(label, []).append((time.perf_counter() - start, status))
+
+        if think_time:
+            await asyncio.sleep(rng.uniform(0, 2 * think_time))
+
+async def run_load(main, args) -> dict:
+    samples: dict[str, list] = {}
+    rng = random.Random(args.seed)
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        mix = {action: float(weight) for action, weight in (part.split("=") for part in args.mix.split(","))}
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://teapot") as client:
+            start = time.monotonic()
+            deadline = start + args.duration
+            await asyncio.gather(*(
+                device(client, f"device{i:04d}", mix, deadline, args.think_ms / 1000,
+                       random.Random(rng.random()), samples)
+                for i in range(args.devices)
+            ))
+            duration = time.monotonic() - start
+            git_status = main.committer.status()
+
+    all_samples = [sample for endpoint in samples.values() for sample in endpoint]
+    return {
+        "duration_s": round(duration, 3),
+        "mix": mix,
+        "overall": summarise(all_samples, duration),
+        "endpoints": {label: summarise(endpoint, duration) for label, endpoint in sorted(samples.items())},
+        "git_at_end_of_load": git_status,
+    }
+
+def git_revision() -> str | None:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def print_results(results: dict):
+    print(f"\n{results['config']['devices']} devices for {results['duration_s']}s "
+          f"({results['config']['storage']} storage, revision {results['revision']})")
+    print(f"{'endpoint':<26} {'count':>7} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(results["endpoints"].items()) + [("overall", results["overall"])]
+    for label, stats in rows:
+        print(f"{label:<26} {stats['count']:>7} {stats['errors']:>6} {stats['throughput_rps']:>8} "
+              f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8}")
+    mqtt = results["mqtt"]
+    print(f"git commits pushed: {results['commits']}, "
+          f"mqtt: {mqtt['connections']} connections, {mqtt['published']} published")
+    if mqtt["stats_topics_missing"]:
+        print(f"no stats published for {len(mqtt['stats_topics_missing'])} users, "
+              f"e.g. {mqtt['stats_topics_missing'][0]}")
+
+def print_comparison(old: dict, new: dict):
+    print(f"\nCompared with {old.get('revision')} ({old.get('started')}):")
+    print(f"{'endpoint':<26} {'req/s':>16} {'p50 ms':>18} {'p99 ms':>18}")
+    old_rows = dict(old["endpoints"], overall=old["overall"])
+    new_rows = dict(new["endpoints"], overall=new["overall"])
+    for label, stats in new_rows.items():
+        if label not in old_rows:
+            continue
+        before = old_rows[label]
+        print(f"{label:<26} "
+              f"{before['throughput_rps']:>7} -> {stats['throughput_rps']:<7} "
+              f"{before['p50_ms']:>8} -> {stats['p50_ms']:<8} "
+              f"{before['p99_ms']:>8} -> {stats['p99_ms']:<8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the tea counter API in-process")
+    parser.add_argument("--devices", type=int, default=20, help="concurrent simulated devices")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a device's requests")
+    parser.add_argument("--mix", help="action weights, e.g. tea=50,coffee=30,undo=5,stats=15")
+    parser.add_argument("--storage", default="text", help="TEAPOT_STORAGE backend to test")
+    parser.add_argument("--seed-data", type=Path, help="data/ directory to start from, e.g. one made by gen_data.py")
+    parser.add_argument("--commit-window", type=float, help="override the git commit window, seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=Path("load_test_results.json"))
+    parser.add_argument("--compare", type=Path, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    output = args.output.resolve()
+    compare = args.compare.resolve() if args.compare else None
+    seed_data = args.seed_data.resolve() if args.seed_data else None
+    revision = git_revision()
+
+    broker = FakeMqttBroker()
+    broker.start()
+
+    work = make_workdir(seed_data)
+    os.chdir(work)
+    os.environ["TEAPOT_STORAGE"] = args.storage
+    os.environ["TEAPOT_MQTT_BROKER"] = broker.host
+    os.environ["TEAPOT_MQTT_PORT"] = str(broker.port)
+    if args.storage == "eventlog" and seed_data:
+        import eventlog
+        eventlog.migrate_from_text(Path("data"), Path("eventlog"))
+    if args.storage == "sqlite" and seed_data:
+        import sqlite_storage
+        sqlite_storage.migrate_from_text(Path("data"), Path("teapot.db"))
+
+    import main as teapot
+    if args.commit_window is not None:
+        teapot.committer.window = args.commit_window
+
+    started = datetime.now(UTC).isoformat()
+    load = asyncio.run(run_load(teapot, args))
+
+    commits = subprocess.run(
+        ["git", "rev-list", "--count", "origin/main"], cwd=work, capture_output=True, text=True
+    ).stdout.strip()
+    results = {
+        "started": started,
+        "revision": revision,
+        "config": {
+            "devices": args.devices,
+            "duration": args.duration,
+            "think_ms": args.think_ms,
+            "storage": args.storage,
+            "seed_data": str(seed_data) if seed_data else None,
+            "commit_window": teapot.committer.window,
+            "seed": args.seed,
+        },
+        **load,
+        "commits": int(commits) - 1 if commits else None,
+        "mqtt": broker.stats(),
+    }
+    # Every user who drank something should have had their stats published
+    expected = {f"{teapot.MQTT_TOPIC}/stats/{username}" for username in teapot.user_counts}
+    results["mqtt"]["stats_topics_missing"] = sorted(broker.missing_topics(expected))
+    broker.stop()
+
+    print_results(results)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if compare:
+        with open(compare, "r") as f:
+            print_comparison(json.load(f), results)
+
+    shutil.rmtree(work.parent, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
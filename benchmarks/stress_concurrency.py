@@ -0,0 +1,176 @@
+"""
+Concurrency stress test for the write paths.
+
+Fires thousands of concurrent tea, coffee and undo requests at a handful of
+users, so the same user is hit from many threads (and, with --processes,
+from several worker processes) at once.  Every successful request is
+tallied, and afterwards the stored drinks, the change journal and the git
+history must all agree with the tally: no drink lost, none counted twice,
+no undo removing the wrong thing.
+
+    python benchmarks/stress_concurrency.py --requests 5000 --users 5 --processes 4
+
+Exits with status 1 if anything doesn't add up.  Needs httpx.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_mqtt_broker import FakeMqttBroker
+from load_test import make_workdir
+
+ACTIONS = ["tea", "coffee", "undo"]
+WEIGHTS = [45, 35, 20]
+
+async def drive(teapot, requests: int, users: int, concurrency: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    plan = [(f"user{rng.randrange(users)}", rng.choices(ACTIONS, WEIGHTS)[0]) for _ in range(requests)]
+    tally = Counter()
+    errors = Counter()
+    gate = asyncio.Semaphore(concurrency)
+
+    async def send(client, username, action):
+        async with gate:
+            response = await client.post(f"/{username}/{action}")
+        if response.status_code != 200:
+            errors[response.status_code] += 1
+            return
+        body = response.json()
+        if action != "undo":
+            tally[f"{username} {action}"] += 1
+        elif body["success"]:
+            drink_type = body["message"].rsplit(" ", 1)[1]
+            tally[f"{username} {drink_type}"] -= 1
+
+    transport = httpx.ASGITransport(app=teapot.app)
+    async with teapot.lifespan(teapot.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://teapot", timeout=None) as client:
+            await asyncio.gather(*(send(client, username, action) for username, action in plan))
+    return {"tally": dict(tally), "errors": dict(errors)}
+
+def run_worker(work: str, env: dict, requests: int, users: int, concurrency: int, seed: int, verbose: bool) -> dict:
+    """One worker process, the equivalent of a uvicorn worker"""
+    os.environ.update(env)
+    os.chdir(work)
+    if not verbose:
+        # A log line per request would drown the result
+        sys.stdout = open(os.devnull, "w")
+    import main as teapot
+    teapot.committer.window = 0.5
+    return asyncio.run(drive(teapot, requests, users, concurrency, seed))
+
+def stored_counts(work: Path, backend: str) -> dict:
+    if backend == "sqlite":
+        from sqlite_storage import SqliteStorage
+        storage = SqliteStorage(work / "teapot.db")
+    elif backend == "binary":
+        from binary_storage import open_binary_storage
+        storage = open_binary_storage(work / "bindata")
+    else:
+        from sharded_storage import open_text_storage
+        storage = open_text_storage(work / "data")
+
+    counts = {}
+    problems = []
+    for user in storage.users():
+        for drink_type, count in storage.user_counts(user).items():
+            counts[f"{user} {drink_type}"] = count
+        timestamps = [timestamp for timestamp, _ in storage.iter_events(user)]
+        if timestamps != sorted(timestamps):
+            problems.append(f"{user}'s drinks are not stored in time order")
+    return counts, problems
+
+def journal_counts(work: Path) -> Counter:
+    counts = Counter()
+    with open(work / "state" / "changes.log", "r") as f:
+        for line in f:
+            username, drink_type, delta, _ = json.loads(line)
+            counts[f"{username} {drink_type}"] += delta
+    return counts
+
+def git(work: Path, *args: str) -> str:
+    return subprocess.run(["git", *args], cwd=work, capture_output=True, text=True).stdout.strip()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=5000, help="requests per process")
+    parser.add_argument("--users", type=int, default=5, help="few users means more contention")
+    parser.add_argument("--concurrency", type=int, default=1000, help="requests in flight per process")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes sharing the data")
+    parser.add_argument("--storage", default="text", choices=["text", "binary", "sqlite"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="don't delete the working directory")
+    parser.add_argument("--verbose", action="store_true", help="show the server's logs")
+    args = parser.parse_args()
+
+    broker = FakeMqttBroker()
+    broker.start()
+    work = make_workdir(None)
+    env = {
+        "TEAPOT_STORAGE": args.storage,
+        "TEAPOT_MQTT_BROKER": broker.host,
+        "TEAPOT_MQTT_PORT": str(broker.port),
+    }
+
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.starmap(run_worker, [
+            (str(work), env, args.requests, args.users, args.concurrency, args.seed + worker, args.verbose)
+            for worker in range(args.processes)
+        ])
+    elapsed = time.perf_counter() - start
+    broker.stop()
+
+    expected = Counter()
+    errors = Counter()
+    for result in results:
+        expected.update(result["tally"])
+        errors.update(result["errors"])
+    total = args.requests * args.processes
+    print(f"{total} requests from {args.processes} process(es) in {elapsed:.1f}s ({total / elapsed:.0f} req/s)")
+
+    stored, problems = stored_counts(work, args.storage)
+    journal = journal_counts(work)
+    for key in sorted(set(expected) | set(stored)):
+        if stored.get(key, 0) != expected.get(key, 0):
+            problems.append(f"{key}: {expected.get(key, 0)} acknowledged but {stored.get(key, 0)} stored")
+        if journal.get(key, 0) != expected.get(key, 0):
+            problems.append(f"{key}: {expected.get(key, 0)} acknowledged but {journal.get(key, 0)} in the journal")
+    if errors:
+        problems.append(f"failed requests by status: {dict(errors)}")
+    if git(work, "status", "--porcelain", "--", "data", "bindata", "teapot.db"):
+        problems.append("stored drinks were left uncommitted")
+    if git(work, "rev-parse", "HEAD") != git(work, "rev-parse", "origin/main"):
+        problems.append("commits were left unpushed")
+
+    for key in sorted(expected):
+        print(f"  {key:<16} {expected[key]:>6}")
+    if args.keep:
+        print(f"Working directory kept at {work}")
+    else:
+        shutil.rmtree(work.parent, ignore_errors=True)
+
+    if problems:
+        print("FAIL")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+    print("PASS: every acknowledged drink and undo is stored, journaled and pushed exactly once")
+
+if __name__ == "__main__":
+    main()
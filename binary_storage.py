@@ -0,0 +1,271 @@
+"""
+Compact binary layout of the text storage engine.
+
+Same tree as the text engine, flat or sharded, but each drink file is
+<drink>.bin holding one little-endian uint32 of epoch seconds per drink,
+4 bytes instead of a 21 byte ISO line.  Reads go through mmap without
+parsing anything: a count is the file size // 4, the last drink is one
+4 byte read, and a time range is a binary search over a memoryview of the
+file.  Backfilled drinks are merged into place, so files stay sorted.
+
+Convert a data/ directory (either layout) into a new binary one, or back:
+
+    python binary_storage.py convert [data_dir] [binary_dir]
+    python binary_storage.py to-text [binary_dir] [data_dir]
+"""
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import sys
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from pathlib import Path
+
+from sharded_storage import MANIFEST, ShardedTextStorage, is_sharded, open_text_storage
+from storage import (
+    DRINKS, TextStorage, epoch_bound, format_timestamp, latest_drink, merge_drinks, parse_timestamp,
+)
+
+RECORD = struct.Struct("<I")
+# Records read at a time while iterating over a file
+READ_CHUNK = 4096
+
+def to_epoch(timestamp: datetime) -> int:
+    return int(timestamp.timestamp())
+
+def from_epoch(epoch: int) -> datetime:
+    return datetime.fromtimestamp(epoch, UTC)
+
+def append_epochs_to_file(filepath: Path, epochs: list[int]):
+    """Append drinks with one write and one fsync"""
+    with open(filepath, "ab") as f:
+        f.write(struct.pack(f"<{len(epochs)}I", *epochs))
+        f.flush()
+        os.fsync(f.fileno())
+
+def insert_epochs_into_file(filepath: Path, epochs: list[int]):
+    """
+    Add drinks with one write and one fsync, keeping the file sorted.  Usually
+    they are the newest and are simply appended; backfilled ones are merged
+    into the records after them, and only those are rewritten.
+    """
+    epochs = sorted(epochs)
+    drop_torn_record(filepath)
+    last = read_last_epoch(filepath)
+    if last is None or last <= epochs[0]:
+        append_epochs_to_file(filepath, epochs)
+        return
+
+    with mapped_epochs(filepath) as existing:
+        start = bisect.bisect_right(existing, epochs[0])
+        later = existing[start:].tolist()
+    merged = list(heapq.merge(later, epochs))
+    with open(filepath, "r+b") as f:
+        f.seek(start * RECORD.size)
+        f.write(struct.pack(f"<{len(merged)}I", *merged))
+        f.flush()
+        os.fsync(f.fileno())
+
+def count_records(filepath: Path) -> int:
+    try:
+        # A torn record from a crash mid-append doesn't count
+        return os.stat(filepath).st_size // RECORD.size
+    except FileNotFoundError:
+        return 0
+
+def drop_torn_record(filepath: Path):
+    """
+    Cut off part of a record left by a crash mid-write, otherwise the records
+    written after it would be misaligned and read back as garbage
+    """
+    try:
+        size = os.stat(filepath).st_size
+    except FileNotFoundError:
+        return
+    if size % RECORD.size:
+        os.truncate(filepath, size - size % RECORD.size)
+
+@contextmanager
+def mapped_epochs(filepath: Path):
+    """The file's epochs as a zero-copy sequence of ints"""
+    if count_records(filepath) == 0:
+        yield memoryview(array("I"))
+        return
+
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        usable = len(mapped) - len(mapped) % RECORD.size
+        if sys.byteorder == "little":
+            view = memoryview(mapped)[:usable].cast("I")
+        else:
+            epochs = array("I", mapped[:usable])
+            epochs.byteswap()
+            view = memoryview(epochs)
+        try:
+            yield view
+        finally:
+            # The mmap can't close while a view of it is alive
+            view.release()
+
+def read_last_epoch(filepath: Path) -> int | None:
+    # A single 4 byte read, cheaper than setting up a mapping
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        count = os.fstat(fd).st_size // RECORD.size
+        if count == 0:
+            return None
+        return RECORD.unpack(os.pread(fd, RECORD.size, (count - 1) * RECORD.size))[0]
+    finally:
+        os.close(fd)
+
+def remove_last_record(filepath: Path) -> bool:
+    count = count_records(filepath)
+    if count == 0:
+        return False
+    with open(filepath, "r+b") as f:
+        f.truncate((count - 1) * RECORD.size)
+        os.fsync(f.fileno())
+    return True
+
+def iter_epochs(filepath: Path, since: int = None, until: int = None):
+    """
+    Epochs in [since, until), found by binary search rather than a scan.  They
+    are read in chunks rather than yielded from the mapping: an undo can
+    truncate the file while the caller is between items, and touching a
+    mapped page past the new end kills the process with SIGBUS.
+    """
+    with mapped_epochs(filepath) as epochs:
+        start = bisect.bisect_left(epochs, since) if since is not None else 0
+        end = bisect.bisect_left(epochs, until) if until is not None else len(epochs)
+    if start >= end:
+        return
+
+    with open(filepath, "rb") as f:
+        for position in range(start, end, READ_CHUNK):
+            size = min(READ_CHUNK, end - position) * RECORD.size
+            data = os.pread(f.fileno(), size, position * RECORD.size)
+            chunk = array("I", data[:len(data) - len(data) % RECORD.size])
+            if sys.byteorder != "little":
+                chunk.byteswap()
+            yield from chunk
+            if len(data) < size:
+                # The file was shortened since the search
+                return
+
+class BinaryStorage(TextStorage):
+    """data/<username>/<drink>.bin"""
+
+    def drink_file(self, username: str, drink_type: str) -> Path:
+        return self.user_dir(username) / f"{drink_type}.bin"
+
+    def append(self, username: str, drink_type: str, timestamp: datetime):
+        insert_epochs_into_file(self.drink_file(username, drink_type), [to_epoch(timestamp)])
+
+    def append_many(self, events: list[tuple[str, str, datetime]]):
+        by_file = {}
+        for username, drink_type, timestamp in events:
+            by_file.setdefault((username, drink_type), []).append(to_epoch(timestamp))
+        for (username, drink_type), epochs in by_file.items():
+            self.init_user(username)
+            insert_epochs_into_file(self.drink_file(username, drink_type), epochs)
+
+    def remove_last(self, username: str, drink_type: str) -> bool:
+        return remove_last_record(self.drink_file(username, drink_type))
+
+    def last_drink(self, username: str) -> tuple:
+        last = {}
+        for drink_type in DRINKS:
+            epoch = read_last_epoch(self.drink_file(username, drink_type))
+            last[drink_type] = from_epoch(epoch) if epoch is not None else None
+        return latest_drink(last["tea"], last["coffee"])
+
+    def user_counts(self, username: str) -> dict[str, int]:
+        return {
+            drink_type: count_records(self.drink_file(username, drink_type))
+            for drink_type in DRINKS
+        }
+
+    def iter_events(self, username: str, since: datetime = None, until: datetime = None):
+        since, until = epoch_bound(since), epoch_bound(until)
+        return (
+            (from_epoch(epoch), drink_type)
+            for epoch, drink_type in merge_drinks({
+                drink_type: iter_epochs(self.drink_file(username, drink_type), since, until)
+                for drink_type in DRINKS
+            })
+        )
+
+class ShardedBinaryStorage(BinaryStorage, ShardedTextStorage):
+    """data/<shard>/<username>/<drink>.bin with a users.txt manifest"""
+
+def open_binary_storage(binary_dir: Path) -> BinaryStorage:
+    """Whichever layout binary_dir is in"""
+    if is_sharded(binary_dir):
+        return ShardedBinaryStorage(binary_dir)
+    return BinaryStorage(binary_dir)
+
+def empty_like(source, destination: Path):
+    """A new, empty storage root with the same layout as source"""
+    destination = Path(destination)
+    if destination.exists() and any(destination.iterdir()):
+        raise ValueError(f"{destination} is not empty, refusing to convert into it")
+    destination.mkdir(parents=True, exist_ok=True)
+    if isinstance(source, ShardedTextStorage):
+        (destination / MANIFEST).touch()
+
+def convert_to_binary(data_dir: Path, binary_dir: Path):
+    """One-off copy of a text data/ tree into a new binary tree with the same layout"""
+    source = open_text_storage(data_dir)
+    empty_like(source, binary_dir)
+    destination = open_binary_storage(binary_dir)
+
+    total = 0
+    for username in source.users():
+        destination.init_user(username)
+        for drink_type in DRINKS:
+            with open(source.drink_file(username, drink_type), "r") as f:
+                epochs = [to_epoch(parse_timestamp(line)) for line in f if line.strip()]
+            if epochs:
+                append_epochs_to_file(destination.drink_file(username, drink_type), epochs)
+            total += len(epochs)
+
+    print(f"Converted {total} drinks into {binary_dir}")
+    return destination
+
+def convert_to_text(binary_dir: Path, data_dir: Path):
+    """The reverse of convert_to_binary, e.g. to read the history in git again"""
+    source = open_binary_storage(binary_dir)
+    empty_like(source, data_dir)
+    destination = open_text_storage(data_dir)
+
+    total = 0
+    for username in source.users():
+        destination.init_user(username)
+        for drink_type in DRINKS:
+            with mapped_epochs(source.drink_file(username, drink_type)) as epochs:
+                lines = "".join(f"{format_timestamp(from_epoch(epoch))}\n" for epoch in epochs)
+                total += len(epochs)
+            with open(destination.drink_file(username, drink_type), "a") as f:
+                f.write(lines)
+
+    print(f"Converted {total} drinks into {data_dir}")
+    return destination
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("convert", "to-text"):
+        print("usage: python binary_storage.py convert [data_dir] [binary_dir]")
+        print("       python binary_storage.py to-text [binary_dir] [data_dir]")
+        sys.exit(1)
+    if sys.argv[1] == "convert":
+        data_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("data")
+        binary_dir = Path(sys.argv[3]) if len(sys.argv) > 3 else Path("bindata")
+        convert_to_binary(data_dir, binary_dir)
+    else:
+        binary_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("bindata")
+        data_dir = Path(sys.argv[3]) if len(sys.argv) > 3 else Path("data")
+        convert_to_text(binary_dir, data_dir)
@@ -0,0 +1,104 @@
+"""
+Celebration rules engine.
+
+Rules are declared in celebrations.json and evaluated against the counter
+deltas handed over by the write path, so deciding whether a drink deserves a
+celebration is O(rules) and never touches the disk.  Each rule is one JSON
+object with a "type":
+
+    global_milestone  everyone's total of "drink" reaches one of "counts"
+    user_milestone    one user's total of "drink" reaches one of "counts"
+    twin_primes       a user's teas and coffees are twin primes
+    streak            a user has had a drink on "days" consecutive days
+
+"message" is formatted with {user}, {count} and {days}.  A rule with
+"target": "all" is broadcast to every screen, otherwise it goes to the user
+who had the drink (global milestones are broadcast by default).
+"""
+import json
+from datetime import date, timedelta
+from pathlib import Path
+
+from primes import is_prime
+
+RULE_TYPES = ("global_milestone", "user_milestone", "twin_primes", "streak")
+
+def are_twin_primes(a: int, b: int) -> bool:
+    """Check if two numbers are twin primes."""
+    return abs(a - b) == 2 and is_prime(a) and is_prime(b)
+
+class Rule:
+    def __init__(self, config: dict):
+        if config.get("type") not in RULE_TYPES:
+            raise ValueError(f"Unknown celebration rule type: {config.get('type')}")
+        self.type = config["type"]
+        self.message = config["message"]
+        self.drink = config.get("drink")
+        self.counts = set(config.get("counts", []))
+        self.days = set(config.get("days", []))
+        default_target = "all" if self.type == "global_milestone" else "user"
+        self.target = config.get("target", default_target)
+
+    def evaluate(self, username: str, drink_type: str, user_counts: dict, totals: dict, streak: int):
+        """The formatted message if this drink triggers the rule, otherwise None"""
+        if self.type == "global_milestone":
+            if drink_type != self.drink or totals[drink_type] not in self.counts:
+                return None
+            count = totals[drink_type]
+        elif self.type == "user_milestone":
+            if drink_type != self.drink or user_counts[drink_type] not in self.counts:
+                return None
+            count = user_counts[drink_type]
+        elif self.type == "twin_primes":
+            if not are_twin_primes(user_counts["tea"], user_counts["coffee"]):
+                return None
+            count = user_counts[drink_type]
+        else:
+            if streak not in self.days:
+                return None
+            count = user_counts[drink_type]
+
+        return self.message.format(user=username, count=count, days=streak)
+
+class CelebrationEngine:
+    def __init__(self, rules: list[Rule]):
+        self.rules = rules
+        # username -> (last day with a drink, consecutive days up to it)
+        self.streaks: dict[str, tuple[date, int]] = {}
+
+    @classmethod
+    def from_file(cls, path: Path):
+        with open(path, "r") as f:
+            return cls([Rule(config) for config in json.load(f)])
+
+    def seed_streak(self, username: str, day: date):
+        """Replay a historical drink day into the streak state, without celebrating"""
+        self.advance_streak(username, day)
+
+    def advance_streak(self, username: str, day: date) -> bool:
+        """Record a drink on this day, True if it's the first drink of the day"""
+        last_day, length = self.streaks.get(username, (None, 0))
+        if last_day == day:
+            return False
+        if last_day is not None and day < last_day:
+            # Backfilled history doesn't move the streak
+            return False
+        length = length + 1 if last_day == day - timedelta(days=1) else 1
+        self.streaks[username] = (day, length)
+        return True
+
+    def on_drink(self, username: str, drink_type: str, user_counts: dict, totals: dict, day: date) -> list[tuple[str, str]]:
+        """
+        Evaluate every rule for a drink that has just been counted.
+        Returns (target, message) pairs, target being "all" or a username.
+        """
+        new_day = self.advance_streak(username, day)
+        # Only the first drink of a day can complete a streak
+        streak = self.streaks[username][1] if new_day else 0
+
+        celebrations = []
+        for rule in self.rules:
+            message = rule.evaluate(username, drink_type, user_counts, totals, streak)
+            if message is not None:
+                celebrations.append(("all" if rule.target == "all" else username, message))
+        return celebrations
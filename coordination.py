@@ -0,0 +1,180 @@
+"""
+Coordination between API worker processes.
+
+uvicorn can run the app in several processes, each with its own memory, so
+anything shared goes through files in the state directory:
+
+    FileLock       an flock() advisory lock, shared or exclusive, that works
+                   between threads as well as processes since every acquire
+                   opens its own file description
+    UserLocks      one lock file per user, so writes for different users
+                   never wait on each other
+    StripedLock    in-process locks picked by a hash of the username, which
+                   a thread takes before the user's lock file so threads of
+                   the same worker queue cheaply in memory
+    ChangeJournal  an append-only log of every change to the counts, which
+                   each worker replays to keep its in-memory index in step
+                   with the others, started afresh by a worker that finds
+                   itself alone at startup
+
+flock() locks are released by the kernel when a process dies, so a crashed
+worker can't leave the others stuck.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import zlib
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+class FileLock:
+    def __init__(self, path: Path, shared: bool = False):
+        self.path = Path(path)
+        self.shared = shared
+        self.fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class UserLocks:
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def path(self, username: str) -> Path:
+        # Hashed so any username makes a safe file name
+        return self.directory / f"{hashlib.sha1(username.encode()).hexdigest()[:16]}.lock"
+
+    @contextmanager
+    def hold(self, *usernames: str):
+        """Lock every given user, always in the same order so two batches can't deadlock"""
+        with ExitStack() as stack:
+            for path in sorted({self.path(username) for username in usernames}):
+                stack.enter_context(FileLock(path))
+            yield
+
+class StripedLock:
+    """A fixed set of locks, one per stripe, so memory doesn't grow with users"""
+
+    def __init__(self, stripes: int = 256):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripe(self, username: str) -> int:
+        return zlib.crc32(username.encode()) % len(self.locks)
+
+    @contextmanager
+    def hold(self, *usernames: str):
+        """Lock the stripes of every given user, in stripe order so two batches can't deadlock"""
+        with ExitStack() as stack:
+            for stripe in sorted({self.stripe(username) for username in usernames}):
+                stack.enter_context(self.locks[stripe])
+            yield
+
+class ChangeJournal:
+    """
+    One JSON line per change: [username, drink type, delta, epoch seconds].
+    Appends are single O_APPEND writes, which the kernel never interleaves,
+    so writers don't need a lock of their own.  Each is fsynced before it
+    returns, like the storage write before it, so a power cut can't keep a
+    drink in storage but lose it from the journal a snapshot is replayed
+    from.  Readers remember how far they have read and only ever consume
+    whole lines.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # How far this process has applied the journal
+        self.offset = 0
+        self.identity = None
+
+    def open(self, flags: int) -> int:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, flags | os.O_CREAT, 0o644)
+        self.identity = os.fstat(fd).st_ino
+        return fd
+
+    def append(self, changes: list[tuple[str, str, int, int]]) -> range:
+        """Write the changes, returns the range of offsets they were written at"""
+        data = "".join(json.dumps(change) + "\n" for change in changes).encode()
+        fd = self.open(os.O_WRONLY | os.O_APPEND)
+        try:
+            written = os.write(fd, data)
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+            os.fsync(fd)
+            return range(end - written, end)
+        finally:
+            os.close(fd)
+
+    def reset(self):
+        """
+        Replace the journal with an empty file.  It is a new inode, so a
+        snapshot or ETag taken from the old one is never mistaken for it.
+        Only safe while no other process reads the journal.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(temporary, "wb") as f:
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self.offset = 0
+        self.end()
+
+    def end(self) -> int:
+        fd = self.open(os.O_RDONLY)
+        try:
+            return os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+    def read_new(self) -> list[tuple[int, list]]:
+        """(offset, change) for everything written since the last call"""
+        fd = self.open(os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size <= self.offset:
+                return []
+            os.lseek(fd, self.offset, os.SEEK_SET)
+            data = b""
+            while len(data) < size - self.offset:
+                chunk = os.read(fd, size - self.offset - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            os.close(fd)
+
+        changes = []
+        position = 0
+        while True:
+            newline = data.find(b"\n", position)
+            if newline == -1:
+                break
+            changes.append((self.offset + position, json.loads(data[position:newline])))
+            position = newline + 1
+        self.offset += position
+        return changes
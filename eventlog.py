@@ -0,0 +1,313 @@
+"""
+Append-only event log storage engine.
+
+All drinks for all users go into one log split into fixed-size segment files.
+Each record is a packed (user id, drink, epoch seconds, kind) struct, so a
+write is a single small append and history is never rewritten.  An undo is
+recorded as a tombstone that cancels the user's latest live drink of that
+type.  User ids are line numbers in users.txt.
+
+Undone drinks and their tombstones stay in the log until it is compacted,
+which rewrites every segment so far as compacted-<N>.log holding only the
+live drinks; on load it replaces segments 0 to N.
+
+Migrate an existing data/ directory, or compact the log with the server
+stopped, with:
+
+    python eventlog.py migrate [data_dir] [log_dir]
+    python eventlog.py compact [log_dir] [state_dir]
+"""
+import bisect
+import os
+import struct
+import sys
+import threading
+from array import array
+from datetime import datetime, UTC
+from pathlib import Path
+
+from coordination import FileLock
+from sharded_storage import open_text_storage
+from storage import DRINKS, Storage, epoch_bound, latest_drink, merge_drinks, parse_timestamp
+
+# user id, drink type, epoch seconds, kind
+RECORD = struct.Struct("<IBIB")
+SEGMENT_RECORDS = 65536
+
+KIND_DRINK = 0
+KIND_UNDO = 1
+
+DRINK_CODES = {drink_type: code for code, drink_type in enumerate(DRINKS)}
+
+class EventLogStorage(Storage):
+    def __init__(self, root: Path = Path("eventlog")):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.users_file = self.root / "users.txt"
+        self.lock = threading.Lock()
+
+        self.user_ids: dict[str, int] = {}
+        self.usernames: list[str] = []
+        # Live (not undone) timestamps per user and drink, oldest first
+        self.live: dict[str, dict[str, array]] = {}
+        self.segment = 0
+        self.segment_records = 0
+
+        self.load()
+
+    def segment_path(self, segment: int) -> Path:
+        return self.root / f"segment-{segment:06d}.log"
+
+    def segments(self) -> list[int]:
+        return sorted(
+            int(path.stem.split("-")[1]) for path in self.root.glob("segment-*.log")
+        )
+
+    def compacted_path(self, segment: int) -> Path:
+        return self.root / f"compacted-{segment:06d}.log"
+
+    def compacted(self) -> int | None:
+        """The last segment folded into the compacted segment, if there is one"""
+        compacted = [int(path.stem.split("-")[1]) for path in self.root.glob("compacted-*.log")]
+        return max(compacted, default=None)
+
+    def load(self):
+        """Replay users.txt, the compacted segment and every later segment into memory"""
+        if self.users_file.exists():
+            with open(self.users_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        self.add_user(line.strip())
+
+        compacted = self.compacted()
+        if compacted is not None:
+            self.replay(self.compacted_path(compacted))
+            self.segment = compacted + 1
+
+        for segment in self.segments():
+            if compacted is not None and segment <= compacted:
+                # Left behind by a compaction that didn't get to delete it
+                continue
+            self.segment = segment
+            self.segment_records = self.replay(self.segment_path(segment))
+
+        # A crash mid-write can leave part of a record at the end of the
+        # last segment.  Cut it off, or the next append would land after it
+        # and every record from there on would be misread
+        path = self.segment_path(self.segment)
+        if path.exists() and path.stat().st_size != self.segment_records * RECORD.size:
+            os.truncate(path, self.segment_records * RECORD.size)
+
+    def replay(self, path: Path) -> int:
+        """Apply every record in a segment file, returns how many there were"""
+        with open(path, "rb") as f:
+            data = f.read()
+        # Ignore a torn record left by a crash mid-write
+        usable = len(data) - len(data) % RECORD.size
+        for user_id, drink_code, epoch, kind in RECORD.iter_unpack(data[:usable]):
+            self.apply(self.usernames[user_id], DRINKS[drink_code], epoch, kind)
+        return usable // RECORD.size
+
+    def add_user(self, username: str):
+        self.user_ids[username] = len(self.usernames)
+        self.usernames.append(username)
+        self.live[username] = {drink_type: array("I") for drink_type in DRINKS}
+
+    def apply(self, username: str, drink_type: str, epoch: int, kind: int):
+        timestamps = self.live[username][drink_type]
+        if kind == KIND_DRINK:
+            # Backfilled drinks go into place, so the newest is always last
+            if timestamps and epoch < timestamps[-1]:
+                bisect.insort(timestamps, epoch)
+            else:
+                timestamps.append(epoch)
+        elif timestamps:
+            timestamps.pop()
+
+    def write(self, username: str, drink_type: str, epoch: int, kind: int):
+        self.write_many([(username, drink_type, epoch, kind)])
+
+    def write_many(self, records: list[tuple[str, str, int, int]]):
+        """Append records with one write and one fsync per segment they land in"""
+        while records:
+            if self.segment_records >= SEGMENT_RECORDS:
+                self.segment += 1
+                self.segment_records = 0
+
+            chunk = records[:SEGMENT_RECORDS - self.segment_records]
+            records = records[len(chunk):]
+            data = b"".join(
+                RECORD.pack(self.user_ids[username], DRINK_CODES[drink_type], epoch, kind)
+                for username, drink_type, epoch, kind in chunk
+            )
+            with open(self.segment_path(self.segment), "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.segment_records += len(chunk)
+
+            for username, drink_type, epoch, kind in chunk:
+                self.apply(username, drink_type, epoch, kind)
+
+    def init_user(self, username: str):
+        with self.lock:
+            if username in self.user_ids:
+                return
+            with open(self.users_file, "a") as f:
+                f.write(f"{username}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.add_user(username)
+
+    def append(self, username: str, drink_type: str, timestamp: datetime):
+        self.init_user(username)
+        with self.lock:
+            self.write(username, drink_type, int(timestamp.timestamp()), KIND_DRINK)
+
+    def append_many(self, events: list[tuple[str, str, datetime]]):
+        for username in {username for username, _, _ in events}:
+            self.init_user(username)
+        with self.lock:
+            self.write_many([
+                (username, drink_type, int(timestamp.timestamp()), KIND_DRINK)
+                for username, drink_type, timestamp in events
+            ])
+
+    def remove_last(self, username: str, drink_type: str) -> bool:
+        with self.lock:
+            if username not in self.live or not self.live[username][drink_type]:
+                return False
+            self.write(username, drink_type, int(datetime.now(UTC).timestamp()), KIND_UNDO)
+            return True
+
+    def last_drink(self, username: str) -> tuple:
+        with self.lock:
+            if username not in self.live:
+                return None, None
+            last = {}
+            for drink_type, timestamps in self.live[username].items():
+                last[drink_type] = datetime.fromtimestamp(timestamps[-1], UTC) if timestamps else None
+        return latest_drink(last["tea"], last["coffee"])
+
+    def users(self) -> list[str]:
+        with self.lock:
+            return list(self.usernames)
+
+    def user_counts(self, username: str) -> dict[str, int]:
+        with self.lock:
+            if username not in self.live:
+                return {drink_type: 0 for drink_type in DRINKS}
+            return {drink_type: len(timestamps) for drink_type, timestamps in self.live[username].items()}
+
+    def iter_events(self, username: str, since: datetime = None, until: datetime = None):
+        since, until = epoch_bound(since), epoch_bound(until)
+        with self.lock:
+            if username not in self.live:
+                return iter(())
+            live = {}
+            for drink_type, timestamps in self.live[username].items():
+                start = bisect.bisect_left(timestamps, since) if since is not None else 0
+                end = bisect.bisect_left(timestamps, until) if until is not None else len(timestamps)
+                live[drink_type] = timestamps[start:end]
+        return (
+            (datetime.fromtimestamp(epoch, UTC), drink_type)
+            for epoch, drink_type in merge_drinks(live)
+        )
+
+    def paths(self, username: str) -> list[str]:
+        # A batch of changes can span a segment rollover
+        return [f"{self.root}/"]
+
+def migrate_from_text(data_dir: Path, log_dir: Path):
+    """One-off copy of a data/ tree, flat or sharded, into an empty event log"""
+    source = open_text_storage(data_dir)
+    if Path(log_dir).exists() and any(Path(log_dir).iterdir()):
+        raise ValueError(f"{log_dir} is not empty, refusing to migrate into it")
+    log = EventLogStorage(log_dir)
+
+    events = []
+    for username in sorted(source.users()):
+        log.init_user(username)
+        for drink_type in DRINKS:
+            drink_file = source.drink_file(username, drink_type)
+            if not drink_file.exists():
+                continue
+            with open(drink_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        events.append((parse_timestamp(line), username, drink_type))
+
+    # Write in time order so the log reads like it was recorded live, with
+    # one write and one fsync per segment rather than per drink
+    events.sort()
+    log.append_many([(username, drink_type, timestamp) for timestamp, username, drink_type in events])
+
+    print(f"Migrated {len(events)} drinks for {len(log.users())} users into {log_dir}")
+    return log
+
+# Held by the server while it has the log open, in its state directory so
+# the lock file is never committed along with the log
+OWNER_LOCK = "eventlog.lock"
+
+def compact(log_dir: Path, state_dir: Path = Path("state")):
+    """Fold every segment so far, undone drinks dropped, into one compacted segment"""
+    log_dir = Path(log_dir)
+    # The server keeps the log in memory, so it mustn't be running
+    owner = FileLock(Path(state_dir) / OWNER_LOCK)
+    if not owner.acquire(blocking=False):
+        raise RuntimeError(f"The server is using {log_dir}, stop it before compacting")
+    try:
+        log = EventLogStorage(log_dir)
+        segments = log.segments()
+        previous = log.compacted()
+        if not segments or (previous is not None and segments[-1] <= previous):
+            print(f"Nothing to compact in {log_dir}")
+            return log
+        last = segments[-1]
+
+        paths = [log.segment_path(segment) for segment in segments]
+        if previous is not None:
+            paths.append(log.compacted_path(previous))
+        before = sum(path.stat().st_size for path in paths) // RECORD.size
+
+        # Each user's drinks keep their order, which later tombstones rely on
+        records = [
+            RECORD.pack(log.user_ids[username], DRINK_CODES[drink_type], epoch, KIND_DRINK)
+            for username in log.usernames
+            for drink_type in DRINKS
+            for epoch in log.live[username][drink_type]
+        ]
+        temporary = log_dir / f".compacted-{last:06d}.log.tmp"
+        with open(temporary, "wb") as f:
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        # Once this rename lands the old segments are ignored, so a crash
+        # before they're deleted is harmless
+        os.replace(temporary, log.compacted_path(last))
+        fd = os.open(log_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        for path in paths:
+            path.unlink()
+        print(f"Compacted {before} records in {len(paths)} files into {len(records)} live drinks")
+        return EventLogStorage(log_dir)
+    finally:
+        owner.release()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrate", "compact"):
+        print("usage: python eventlog.py migrate [data_dir] [log_dir]")
+        print("       python eventlog.py compact [log_dir] [state_dir]")
+        sys.exit(1)
+    if sys.argv[1] == "migrate":
+        data_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("data")
+        log_dir = Path(sys.argv[3]) if len(sys.argv) > 3 else Path("eventlog")
+        migrate_from_text(data_dir, log_dir)
+    else:
+        log_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("eventlog")
+        state_dir = Path(sys.argv[3]) if len(sys.argv) > 3 else Path("state")
+        compact(log_dir, state_dir)
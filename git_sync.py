@@ -0,0 +1,166 @@
+"""
+Background git persistence.
+
+Request handlers only mark a user as changed; a worker task collects those
+changes for a short window and turns them into one commit and one push, so a
+drink never waits on the network and users are not serialized behind each
+other's pushes.  git runs as asyncio subprocesses, so nothing here blocks the
+event loop.
+"""
+import asyncio
+import time
+from collections import deque
+from datetime import datetime, UTC
+from pathlib import Path
+
+from coordination import FileLock
+from metrics import GIT_FAILURES
+from tracing import log, span
+
+# Commit whatever has arrived after this many seconds, or this many changes
+COMMIT_WINDOW = 5.0
+MAX_BATCH = 100
+
+async def run_git(*args: str) -> tuple[int, str, str]:
+    process = await asyncio.create_subprocess_exec(
+        "git", *args,
+        cwd=Path.cwd(),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    return process.returncode, stdout.decode(), stderr.decode()
+
+async def git_commit_and_push(paths: list[str], commit_message: str) -> bool:
+    """Commit the given paths and push to GitHub"""
+    summary = commit_message.splitlines()[0]
+    try:
+        # Add all changes to the stored drinks
+        with span("git_add"):
+            returncode, _, stderr = await run_git("add", *paths)
+        if returncode != 0:
+            GIT_FAILURES.inc(step="add")
+            log("git_add_failed", level="error", summary=summary, stderr=stderr)
+            return False
+
+        # Commit changes, an undo can cancel out a drink in the same batch
+        with span("git_commit"):
+            returncode, stdout, stderr = await run_git("commit", "-m", commit_message)
+        if returncode != 0 and "nothing to commit" not in stdout:
+            GIT_FAILURES.inc(step="commit")
+            log("git_commit_failed", level="error", summary=summary, stderr=stderr)
+            return False
+
+        # Push to GitHub, this also pushes any earlier commits whose push failed
+        with span("git_push"):
+            returncode, _, stderr = await run_git("push", "origin", "main")
+        if returncode != 0:
+            GIT_FAILURES.inc(step="push")
+            log("git_push_failed", level="error", summary=summary, stderr=stderr)
+            return False
+
+        log("git_pushed", summary=summary)
+        return True
+
+    except Exception as e:
+        GIT_FAILURES.inc(step="error")
+        log("git_error", level="error", error=str(e))
+        return False
+
+class GitCommitter:
+    def __init__(self, storage, window: float = COMMIT_WINDOW, max_batch: int = MAX_BATCH, lock_path: Path = None):
+        self.storage = storage
+        # Held while running git, since other worker processes commit from the same checkout
+        self.lock_path = lock_path
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.stopping = False
+        # Submit times of changes still waiting in the queue, oldest first
+        self.queued_times = deque()
+
+        self.last_push = None
+        # When the oldest change that hasn't reached GitHub yet was made
+        self.oldest_unpushed = None
+
+    def start(self):
+        """Start the worker, must be called from the running event loop"""
+        self.stopping = False
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Commit and push anything still queued, then stop the worker"""
+        self.stopping = True
+        if self.task:
+            await self.task
+
+    def submit(self, username: str, description: str):
+        """Queue a change, description like 'tea' or 'undo coffee'"""
+        now = time.time()
+        if self.oldest_unpushed is None:
+            self.oldest_unpushed = now
+        self.queued_times.append(now)
+        self.queue.put_nowait((username, description, now))
+
+    async def next_batch(self) -> list:
+        try:
+            batch = [await asyncio.wait_for(self.queue.get(), timeout=0.5)]
+        except asyncio.TimeoutError:
+            return []
+
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch and not self.stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while not (self.stopping and self.queue.empty()):
+            batch = await self.next_batch()
+            if batch:
+                await self.commit(batch)
+
+    async def commit(self, batch: list):
+        users = sorted({username for username, _, _ in batch})
+        paths = sorted({path for username in users for path in self.storage.paths(username)})
+
+        if len(batch) == 1:
+            username, description, timestamp = batch[0]
+            commit_message = f"{username} registered {description} at {datetime.fromtimestamp(timestamp, UTC).isoformat()}"
+        else:
+            commit_message = f"{len(batch)} changes from {', '.join(users)}\n\n" + "\n".join(
+                f"{username} registered {description} at {datetime.fromtimestamp(timestamp, UTC).isoformat()}"
+                for username, description, timestamp in batch
+            )
+
+        for _ in batch:
+            self.queued_times.popleft()
+
+        await asyncio.to_thread(self.storage.sync)
+        lock = FileLock(self.lock_path) if self.lock_path else None
+        if lock:
+            await asyncio.to_thread(lock.acquire)
+        try:
+            pushed = await git_commit_and_push(paths, commit_message)
+        finally:
+            if lock:
+                lock.release()
+
+        if pushed:
+            self.last_push = time.time()
+            # Whatever is still queued arrived after this batch
+            self.oldest_unpushed = self.queued_times[0] if self.queued_times else None
+
+    def status(self) -> dict:
+        now = time.time()
+        return {
+            "queue_depth": self.queue.qsize(),
+            "last_push": datetime.fromtimestamp(self.last_push, UTC).isoformat() if self.last_push else None,
+            "push_lag_seconds": round(now - self.oldest_unpushed, 3) if self.oldest_unpushed else 0.0,
+        }
@@ -0,0 +1,90 @@
+"""
+Rebuilding the counter index from the whole drink history at startup.
+
+Every user's history is summed up into a small summary:
+
+    counts  {"tea": n, "coffee": n}
+    days    {day ordinal: {"tea": n, "coffee": n}}, a rollup per day
+
+For the file based engines the users are split into shards which a pool of
+processes summarize in parallel, each opening the data directory for itself,
+and the partial summaries are merged as they come back.  A progress line is
+logged for every finished shard, so a slow restart can be watched.  The
+event log and SQLite engines, and small data directories, are summarized in
+this process.
+"""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from storage import DRINKS, TextStorage
+from tracing import log
+
+# Below this many users a pool costs more than it saves
+PARALLEL_MIN_USERS = 64
+# Shards per worker, so progress is reported more than once per worker and
+# a slow shard doesn't leave the others idle
+SHARDS_PER_WORKER = 4
+
+def empty_summary() -> dict:
+    return {"counts": {drink_type: 0 for drink_type in DRINKS}, "days": {}}
+
+def summarize(storage, username: str) -> dict:
+    summary = empty_summary()
+    for timestamp, drink_type in storage.iter_events(username):
+        summary["counts"][drink_type] += 1
+        day = summary["days"].setdefault(timestamp.toordinal(), {drink_type: 0 for drink_type in DRINKS})
+        day[drink_type] += 1
+    return summary
+
+def merge(summaries: dict, partial: dict):
+    """Add partial summaries into summaries, for users in either"""
+    for username, part in partial.items():
+        if username not in summaries:
+            summaries[username] = part
+            continue
+        summary = summaries[username]
+        for drink_type in DRINKS:
+            summary["counts"][drink_type] += part["counts"][drink_type]
+        for ordinal, day_counts in part["days"].items():
+            day = summary["days"].setdefault(ordinal, {drink_type: 0 for drink_type in DRINKS})
+            for drink_type in DRINKS:
+                day[drink_type] += day_counts[drink_type]
+
+def summarize_shard(storage_type: type, root: str, usernames: list[str]) -> dict:
+    """Runs in a worker process, with its own view of the data directory"""
+    storage = storage_type(root)
+    return {username: summarize(storage, username) for username in usernames}
+
+def summarize_all(storage, workers: int) -> dict:
+    """username -> summary for every user in storage"""
+    start = time.perf_counter()
+    usernames = sorted(storage.users())
+    summaries = {}
+
+    # Only engines that are just files can be reopened in another process
+    if workers <= 1 or len(usernames) < PARALLEL_MIN_USERS or not isinstance(storage, TextStorage):
+        merge(summaries, {username: summarize(storage, username) for username in usernames})
+        log("index_rebuilt", users=len(usernames), workers=1, duration_s=round(time.perf_counter() - start, 3))
+        return summaries
+
+    shard_count = min(len(usernames), workers * SHARDS_PER_WORKER)
+    shards = [usernames[i::shard_count] for i in range(shard_count)]
+    done = 0
+    # Forked rather than spawned, so the workers don't import the app again.
+    # This runs before the server starts its own threads.
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        futures = [pool.submit(summarize_shard, type(storage), str(storage.root), shard) for shard in shards]
+        for future in as_completed(futures):
+            partial = future.result()
+            merge(summaries, partial)
+            done += len(partial)
+            log(
+                "index_progress",
+                users_done=done,
+                users=len(usernames),
+                duration_s=round(time.perf_counter() - start, 3),
+            )
+
+    log("index_rebuilt", users=len(usernames), workers=workers, duration_s=round(time.perf_counter() - start, 3))
+    return summaries
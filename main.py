@@ -1,23 +1,179 @@
+import asyncio
 import json
 import os
-import subprocess
-from fastapi import FastAPI
-from datetime import datetime, UTC
+import time
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from datetime import date, datetime, timedelta, UTC
 from pathlib import Path
 import threading
-import paho.mqtt.publish as publish
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Literal
-
-lock = threading.Lock()
+from binary_storage import open_binary_storage
+from sharded_storage import open_text_storage
+from eventlog import OWNER_LOCK, EventLogStorage
+from sqlite_storage import SqliteStorage
+from git_sync import GitCommitter
+from mqtt_publisher import MqttPublisher
+from celebrations import CelebrationEngine
+from coordination import ChangeJournal, FileLock, StripedLock, UserLocks
+import export
+from index_build import summarize_all
+import primes
+from snapshot import SNAPSHOT_FILE, read_snapshot, write_snapshot
+import metrics
+from metrics import MQTT_FAILURES, REQUEST_LATENCY
+from profiler import RequestProfiler
+from tracing import Trace, current_trace, log, new_request_id, span
+
+counter_lock = threading.Lock()
 
 # mqtt setup
-MQTT_BROKER = "192.168.101.197"
+MQTT_BROKER = os.environ.get("TEAPOT_MQTT_BROKER", "192.168.101.197")
+MQTT_PORT = int(os.environ.get("TEAPOT_MQTT_PORT", "1883"))
 MQTT_TOPIC = "teacounter"
-
-MILESTONES = [100, 200, 300, 314, 400, 500, 1000]
-
-app = FastAPI(title="Tea counter")
+publisher = MqttPublisher(MQTT_BROKER, MQTT_PORT)
+
+CELEBRATIONS_FILE = Path(os.environ.get("TEAPOT_CELEBRATIONS", Path(__file__).parent / "celebrations.json"))
+celebration_engine = CelebrationEngine.from_file(CELEBRATIONS_FILE)
+
+# storage setup, "text" (data/<user>/<drink>.txt, optionally sharded), "binary", "eventlog" or "sqlite"
+STORAGE_BACKEND = os.environ.get("TEAPOT_STORAGE", "text")
+DATA_DIR = Path(os.environ.get("TEAPOT_DATA_DIR", "data"))
+BINARY_DIR = Path(os.environ.get("TEAPOT_BINARY_DIR", "bindata"))
+EVENTLOG_DIR = Path(os.environ.get("TEAPOT_EVENTLOG_DIR", "eventlog"))
+DB_PATH = Path(os.environ.get("TEAPOT_DB_PATH", "teapot.db"))
+# Server-side bookkeeping that isn't drink history, never committed
+STATE_DIR = Path(os.environ.get("TEAPOT_STATE_DIR", "state"))
+EVENT_IDS_FILE = STATE_DIR / "event_ids.txt"
+# Writers hold this shared, anything that needs storage to stand still holds it exclusively
+WRITERS_LOCK = STATE_DIR / "writers.lock"
+GIT_LOCK = STATE_DIR / "git.lock"
+# Starting workers take turns, and running workers hold this shared for as
+# long as they read the journal, so a worker that starts alone can rotate it
+STARTUP_LOCK = STATE_DIR / "startup.lock"
+WORKERS_LOCK = STATE_DIR / "workers.lock"
+worker_running = FileLock(WORKERS_LOCK, shared=True)
+
+# Profile every Nth request (0 is off) and keep the last few profiles in memory
+PROFILE_EVERY = int(os.environ.get("TEAPOT_PROFILE_EVERY", "0"))
+PROFILE_KEEP = int(os.environ.get("TEAPOT_PROFILE_KEEP", "20"))
+profiler = RequestProfiler(PROFILE_EVERY, PROFILE_KEEP)
+
+# Processes that scan the history in parallel when the index is rebuilt at startup
+INDEX_WORKERS = int(os.environ.get("TEAPOT_INDEX_WORKERS", str(os.cpu_count() or 1)))
+# Seconds between snapshots of the index (0 is off, the index is then rebuilt on every start)
+SNAPSHOT_INTERVAL = float(os.environ.get("TEAPOT_SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_PATH = STATE_DIR / SNAPSHOT_FILE
+
+# The event log keeps its state in memory, so only one process may use it
+eventlog_owner = FileLock(STATE_DIR / OWNER_LOCK)
+
+def open_storage(backend: str):
+    if backend == "text":
+        # Flat or sharded, depending on whether DATA_DIR has been migrated
+        return open_text_storage(DATA_DIR)
+    if backend == "binary":
+        return open_binary_storage(BINARY_DIR)
+    if backend == "eventlog":
+        if not eventlog_owner.acquire(blocking=False):
+            raise RuntimeError("The event log is open in another process, run a single worker with TEAPOT_STORAGE=eventlog")
+        return EventLogStorage(EVENTLOG_DIR)
+    if backend == "sqlite":
+        return SqliteStorage(DB_PATH)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def storage_source() -> str:
+    """Which data a snapshot was taken from"""
+    location = {"text": DATA_DIR, "binary": BINARY_DIR, "eventlog": EVENTLOG_DIR, "sqlite": DB_PATH}[STORAGE_BACKEND]
+    return f"{STORAGE_BACKEND}:{location.resolve()}"
+
+storage = open_storage(STORAGE_BACKEND)
+committer = GitCommitter(storage, lock_path=GIT_LOCK)
+
+# In-memory counter index, built once at startup and kept up to date by
+# replaying the change journal, which every worker process writes to, so that
+# stats never have to re-read the data files.
+user_counts: dict[str, dict[str, int]] = {}
+total_counts = {"tea": 0, "coffee": 0}
+# username -> day ordinal -> that day's counts
+daily_counts: dict[str, dict[int, dict[str, int]]] = {}
+journal = ChangeJournal(STATE_DIR / "changes.log")
+user_locks = UserLocks(STATE_DIR / "locks")
+user_stripes = StripedLock()
+
+# How long after a drink it can still be undone
+UNDO_WINDOW = timedelta(minutes=1)
+
+# How far into the journal the last snapshot this process wrote goes
+snapshot_offset = None
+snapshot_lock = threading.Lock()
+
+# Ids of bulk events already stored, so devices can safely resend their queues
+seen_event_ids: set[str] = set()
+# How much of EVENT_IDS_FILE has been read into seen_event_ids
+event_ids_offset = 0
+event_ids_lock = threading.Lock()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with FileLock(STARTUP_LOCK):
+        if not load_snapshot():
+            build_counter_index()
+        rotate_journal()
+        if SNAPSHOT_INTERVAL > 0:
+            save_snapshot()
+        worker_running.acquire()
+    load_event_ids()
+    committer.start()
+    publisher.start()
+    await asyncio.to_thread(publish_all_stats)
+    snapshotter = asyncio.create_task(save_snapshots()) if SNAPSHOT_INTERVAL > 0 else None
+    yield
+    if snapshotter:
+        snapshotter.cancel()
+        await asyncio.to_thread(save_snapshot)
+    await committer.stop()
+    await asyncio.to_thread(publisher.stop)
+    worker_running.release()
+
+app = FastAPI(title="Tea counter", lifespan=lifespan)
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    # Keep a request id handed over by a proxy, if it looks like one
+    request_id = request.headers.get("x-request-id", "")
+    if not (0 < len(request_id) <= 64 and request_id.replace("-", "").isalnum()):
+        request_id = new_request_id()
+    trace = Trace(request_id)
+    current_trace.set(trace)
+    sampler = profiler.maybe_start()
+
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        duration = trace.elapsed()
+        # The route template rather than the path, so every user shares one series
+        route = request.scope.get("route")
+        route = route.path if route else "unmatched"
+        REQUEST_LATENCY.observe(duration, method=request.method, route=route, status=status)
+        if sampler:
+            # Stopping joins the sampler thread, which mustn't hold up the event loop
+            await asyncio.to_thread(profiler.finish, sampler, request_id, request.method, request.url.path, duration)
+        log(
+            "request",
+            method=request.method,
+            path=request.url.path,
+            route=route,
+            status=status,
+            duration_ms=round(duration * 1000, 3),
+            spans=trace.span_fields(),
+        )
 
 def broadcast_message(type: str, message: str):
     try:
@@ -27,10 +183,11 @@ def broadcast_message(type: str, message: str):
             "timestamp": datetime.now(UTC).isoformat()
         }
         topic = f"{MQTT_TOPIC}/all"
-        publish.single(topic, payload=json.dumps(payload), hostname=MQTT_BROKER)
-        print(f"Broadcast {message}")
+        publisher.publish(topic, json.dumps(payload))
+        log("mqtt_broadcast", message=message)
     except Exception as e:
-        print(f"MQTT broadcast failed: {e}")
+        MQTT_FAILURES.inc(reason="error")
+        log("mqtt_broadcast_failed", level="error", error=str(e))
 
 def broadcast_celebration(message: str):
     try:
@@ -40,10 +197,11 @@ def broadcast_celebration(message: str):
             "timestamp": datetime.now(UTC).isoformat(),
         }
         topic = f"{MQTT_TOPIC}/all"
-        publish.single(topic, payload=json.dumps(payload), hostname=MQTT_BROKER)
-        print(f"Celebration sent: {message}")
+        publisher.publish(topic, json.dumps(payload))
+        log("celebration_sent", message=message)
     except Exception as e:
-        print(f"MQTT celebration broadcast failed: {e}")
+        MQTT_FAILURES.inc(reason="error")
+        log("mqtt_celebration_failed", level="error", error=str(e))
 
 def send_message_to_screen(message: str, targets: list[str]):
     """
@@ -55,14 +213,15 @@ def send_message_to_screen(message: str, targets: list[str]):
             "message": message,
             "timestamp": datetime.now(UTC).isoformat()
         }
-        # Send to specific people
+        # Send to specific people, all over the one connection
         for screen_id in targets:
             topic = f"{MQTT_TOPIC}/{screen_id}"
-            publish.single(topic, payload=json.dumps(payload), hostname=MQTT_BROKER)
-            print(f"Published to {screen_id}: {message}")
+            publisher.publish(topic, json.dumps(payload))
+            log("mqtt_published", screen=screen_id, message=message)
 
     except Exception as e:
-        print(f"MQTT publish failed: {e}")
+        MQTT_FAILURES.inc(reason="error")
+        log("mqtt_publish_failed", level="error", error=str(e))
 
 def send_celebration_to_screen(message: str, targets: list[str]):
     """
@@ -74,218 +233,463 @@ def send_celebration_to_screen(message: str, targets: list[str]):
             "message": message,
             "timestamp": datetime.now(UTC).isoformat()
         }
-        # Send to specific people
+        # Send to specific people, all over the one connection
         for screen_id in targets:
             topic = f"{MQTT_TOPIC}/{screen_id}"
-            publish.single(topic, payload=json.dumps(payload), hostname=MQTT_BROKER)
-            print(f"Published to {screen_id}: {message}")
+            publisher.publish(topic, json.dumps(payload))
+            log("mqtt_published", screen=screen_id, message=message)
 
     except Exception as e:
-        print(f"MQTT publish failed: {e}")
+        MQTT_FAILURES.inc(reason="error")
+        log("mqtt_publish_failed", level="error", error=str(e))
+
+@contextmanager
+def writing(*usernames: str):
+    """Hold the locks for changing these users' drinks, across every worker"""
+    with ExitStack() as stack:
+        with span("wait_for_lock"):
+            # Threads of this process queue on a striped lock before going to the lock files
+            stack.enter_context(user_stripes.hold(*usernames))
+            stack.enter_context(FileLock(WRITERS_LOCK, shared=True))
+            stack.enter_context(user_locks.hold(*usernames))
+        yield
 
 def init_user(username: str):
-    user_dir = Path(f"./data/{username}")
-    user_dir.mkdir(exist_ok=True, parents=True)
-
-    tea_file = user_dir / "tea.txt"
-    coffee_file = user_dir / "coffee.txt"
-
-    if not tea_file.exists():
-        tea_file.touch()
-    if not coffee_file.exists():
-        coffee_file.touch()
-
-def append_timestamp_to_file(filepath: Path):
-    timestamp = datetime.now(tz=UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
-    with open(filepath, "a") as f:
-        f.write(f"{timestamp}\n")
-
-def increment_coffee(username: str):
-    append_timestamp_to_file(filepath=Path(f"data/{username}/coffee.txt"))
-
-def increment_tea(username: str):
-    append_timestamp_to_file(filepath=Path(f"data/{username}/tea.txt"))
-
-def count_lines_in_file(filepath: Path) -> int:
-    if not filepath.exists():
-        return 0
-    
-    with open(filepath, "r") as f:
-        return len([line for line in f if line.strip()])
-
-def remove_last_line_from_file(filepath: Path) -> bool:
-    """Remove the last non-empty line from a file"""
-    if not filepath.exists():
+    with span("init_user"):
+        storage.init_user(username)
+
+def increment_coffee(username: str) -> tuple[dict, list]:
+    with writing(username):
+        # Taken under the lock, so each user's drinks are stored in time order
+        timestamp = datetime.now(tz=UTC)
+        with span("append"):
+            storage.append(username, "coffee", timestamp)
+        return update_counter(username, "coffee", 1, timestamp)
+
+def increment_tea(username: str) -> tuple[dict, list]:
+    with writing(username):
+        # Taken under the lock, so each user's drinks are stored in time order
+        timestamp = datetime.now(tz=UTC)
+        with span("append"):
+            storage.append(username, "tea", timestamp)
+        return update_counter(username, "tea", 1, timestamp)
+
+def remove_last_drink(username: str, max_age: timedelta) -> tuple:
+    """
+    Undo the user's most recent drink if it is no older than max_age.  The
+    drink is looked up and removed under the user's lock, so one registered
+    in between can't be removed in its place.  Returns the (drink type,
+    timestamp) that was last and the stats afterwards, or None for the stats
+    if nothing was undone.
+    """
+    with writing(username):
+        drink_type, last_time = get_last_drink_info(username)
+        if not drink_type or not last_time or datetime.now(UTC) - last_time > max_age:
+            return drink_type, last_time, None
+
+        with span("remove_last"):
+            removed = storage.remove_last(username, drink_type)
+        if not removed:
+            return drink_type, last_time, None
+        # Journaled at the drink's own time, so it comes off the right day
+        stats, _ = update_counter(username, drink_type, -1, last_time)
+        return drink_type, last_time, stats
+
+def build_counter_index():
+    """Count every user's drinks once so stats can be served from memory"""
+    # Nobody may write while we count, or their change would be counted
+    # again when we replay the journal from here
+    with FileLock(WRITERS_LOCK):
+        summaries = summarize_all(storage, INDEX_WORKERS)
+        journal_end = journal.end()
+
+    counts = {user: summary["counts"] for user, summary in summaries.items()}
+    with counter_lock:
+        journal.offset = journal_end
+        user_counts.clear()
+        user_counts.update(counts)
+        total_counts["tea"] = sum(c["tea"] for c in counts.values())
+        total_counts["coffee"] = sum(c["coffee"] for c in counts.values())
+        daily_counts.clear()
+        daily_counts.update({user: summary["days"] for user, summary in summaries.items()})
+
+        # Streaks need to know which days each user has been drinking
+        for user, days in daily_counts.items():
+            for ordinal in sorted(days):
+                celebration_engine.seed_streak(user, date.fromordinal(ordinal))
+
+    log("counter_index_built", users=len(counts))
+
+def rotate_journal():
+    """
+    Start an empty journal if no other worker is reading this one.  Called at
+    startup once the index has caught up with all of it, so the old journal
+    is no longer needed by this worker, and the snapshot written straight
+    after starts from the new one.
+    """
+    global snapshot_offset
+    alone = FileLock(WORKERS_LOCK)
+    if not alone.acquire(blocking=False):
+        return
+    try:
+        with FileLock(WRITERS_LOCK), counter_lock:
+            catch_up()
+            size = journal.offset
+            if size == 0:
+                return
+            journal.reset()
+            snapshot_offset = None
+        log("journal_rotated", bytes=size)
+    finally:
+        alone.release()
+
+def save_snapshot():
+    """Write the index to SNAPSHOT_PATH, unless nothing changed since the last one"""
+    global snapshot_offset
+    with snapshot_lock:
+        with counter_lock:
+            catch_up()
+            if journal.offset == snapshot_offset:
+                return
+            offset = journal.offset
+            state = {
+                "source": storage_source(),
+                "journal": journal.identity,
+                "offset": offset,
+                "counts": {user: dict(counts) for user, counts in user_counts.items()},
+                "days": {
+                    user: {ordinal: [day["tea"], day["coffee"]] for ordinal, day in days.items()}
+                    for user, days in daily_counts.items()
+                },
+                "streaks": {user: [day.toordinal(), length] for user, (day, length) in celebration_engine.streaks.items()},
+                "sieve_bound": primes.sieve.bound,
+            }
+        write_snapshot(SNAPSHOT_PATH, state)
+        snapshot_offset = offset
+    log("snapshot_saved", offset=offset, users=len(state["counts"]))
+
+async def save_snapshots():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await asyncio.to_thread(save_snapshot)
+        except OSError as e:
+            log("snapshot_failed", level="error", error=str(e))
+
+def load_snapshot() -> bool:
+    """
+    Restore the index from the last snapshot and replay the journal written
+    since it, False if there's no snapshot of this storage and journal.
+    """
+    global snapshot_offset
+    if SNAPSHOT_INTERVAL <= 0:
         return False
-    
-    with open(filepath, "r") as f:
-        lines = [line for line in f if line.strip()]
-    
-    if not lines:
+    start = time.perf_counter()
+    state = read_snapshot(SNAPSHOT_PATH)
+    if state is None:
         return False
-    
-    lines = lines[:-1]
-    
-    with open(filepath, "w") as f:
-        f.writelines(lines)
-    
+    journal_end = journal.end()
+    if state["source"] != storage_source():
+        log("snapshot_ignored", reason="storage", source=state["source"])
+        return False
+    if state["journal"] != journal.identity or state["offset"] > journal_end:
+        log("snapshot_ignored", reason="journal")
+        return False
+
+    with counter_lock:
+        user_counts.clear()
+        user_counts.update(state["counts"])
+        total_counts["tea"] = sum(c["tea"] for c in user_counts.values())
+        total_counts["coffee"] = sum(c["coffee"] for c in user_counts.values())
+        daily_counts.clear()
+        daily_counts.update({
+            user: {int(ordinal): {"tea": tea, "coffee": coffee} for ordinal, (tea, coffee) in days.items()}
+            for user, days in state["days"].items()
+        })
+        celebration_engine.streaks.clear()
+        celebration_engine.streaks.update({
+            user: (date.fromordinal(ordinal), length) for user, (ordinal, length) in state["streaks"].items()
+        })
+        primes.sieve.extend(state["sieve_bound"])
+
+        journal.offset = state["offset"]
+        catch_up()
+        replayed = journal.offset - state["offset"]
+        snapshot_offset = state["offset"]
+
+    log(
+        "snapshot_loaded",
+        offset=state["offset"],
+        replayed_bytes=replayed,
+        users=len(user_counts),
+        duration_s=round(time.perf_counter() - start, 3),
+    )
     return True
 
-def get_last_drink_info(username: str) -> tuple:
-    """Get the last drink type and timestamp"""
-    user_dir = Path(f"data/{username}")
-    if not user_dir.exists():
-        return None, None
-    
-    tea_file = user_dir / "tea.txt"
-    coffee_file = user_dir / "coffee.txt"
-    
-    last_tea_time = None
-    last_coffee_time = None
-    
-    if tea_file.exists():
-        with open(tea_file, "r") as f:
-            lines = [line.strip() for line in f if line.strip()]
-            if lines:
-                last_tea_time = datetime.fromisoformat(lines[-1].replace('Z', '+00:00'))
-    
-    if coffee_file.exists():
-        with open(coffee_file, "r") as f:
-            lines = [line.strip() for line in f if line.strip()]
-            if lines:
-                last_coffee_time = datetime.fromisoformat(lines[-1].replace('Z', '+00:00'))
-    
-    if last_tea_time and last_coffee_time:
-        if last_tea_time > last_coffee_time:
-            return "tea", last_tea_time
+def update_counter(username: str, drink_type: str, delta: int, timestamp: datetime = None) -> tuple[dict, list]:
+    """
+    Record a change in the journal and apply it to the index, returns the
+    user's stats straight after it and the celebrations a new drink earned.
+    Called with the user's write lock held.
+    """
+    timestamp = timestamp or datetime.now(UTC)
+    with counter_lock:
+        written = journal.append([(username, drink_type, delta, int(timestamp.timestamp()))])
+        celebrations = catch_up(celebrate=written if delta > 0 else None)
+        stats = stats_for(username)
+        publish_stats(username)
+    return stats, celebrations
+
+def catch_up(celebrate: range = None) -> list:
+    """
+    Apply every change in the journal this process hasn't seen yet, including
+    other workers' changes.  Called with counter_lock held.  Returns the
+    celebrations earned by the drinks at offsets in celebrate, which are the
+    ones this process has just written; since milestones are checked in
+    journal order, exactly one worker celebrates each one.
+    """
+    celebrations = []
+    for offset, (username, drink_type, delta, epoch) in journal.read_new():
+        counts = user_counts.setdefault(username, {"tea": 0, "coffee": 0})
+        counts[drink_type] += delta
+        total_counts[drink_type] += delta
+        day = datetime.fromtimestamp(epoch, UTC).date()
+        days = daily_counts.setdefault(username, {})
+        days.setdefault(day.toordinal(), {"tea": 0, "coffee": 0})[drink_type] += delta
+        if delta <= 0:
+            continue
+
+        if celebrate is not None and offset in celebrate:
+            with span("check_celebrations"):
+                celebrations += celebration_engine.on_drink(username, drink_type, counts, total_counts, day)
         else:
-            return "coffee", last_coffee_time
-    elif last_tea_time:
-        return "tea", last_tea_time
-    elif last_coffee_time:
-        return "coffee", last_coffee_time
-    else:
-        return None, None
+            celebration_engine.seed_streak(username, day)
+    return celebrations
+
+def current_etag() -> str:
+    """Catch up with the other workers, then the ETag for the counts as they are now"""
+    with counter_lock:
+        catch_up()
+        # Journal offsets only grow, and the inode tells a recreated journal apart
+        return f'"{journal.identity}-{journal.offset}"'
+
+def stats_for(username: str) -> dict:
+    """The user's counts and the totals, called with counter_lock held"""
+    counts = user_counts.get(username, {"tea": 0, "coffee": 0})
+    return {
+        "user": username,
+        "user_tea": counts["tea"],
+        "user_coffee": counts["coffee"],
+        "all_tea": total_counts["tea"],
+        "all_coffee": total_counts["coffee"],
+    }
 
-def git_commit_and_push(username: str, drink_type: str):
-    """Commit changes and push to GitHub"""
-    try:
-        with lock:
-            # Add all changes in data directory
-            result = subprocess.run(["git", "add", f"data/{username}/"], cwd=Path.cwd(), capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"Failed to add files for {username}'s {drink_type}: {result.stderr}")
-                return False
-            
-            # Create commit message
-            commit_message = f"{username} registered {drink_type} at {datetime.now(UTC).isoformat()}"
-            
-            # Commit changes
-            result = subprocess.run(["git", "commit", "-m", commit_message], cwd=Path.cwd(), capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"Failed to commit {username}'s {drink_type}: {result.stderr}")
-                return False
-            
-            # Push to GitHub
-            result = subprocess.run(["git", "push", "origin", "main"], cwd=Path.cwd(), capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"Failed to push {username}'s {drink_type}: {result.stderr}")
-                return False
-                
-            print(f"Successfully pushed {username}'s {drink_type} to GitHub")
-            return True
-        
-    except Exception as e:
-        print(f"Unexpected error in git operations: {str(e)}")
-        return False
+def publish_stats(username: str):
+    """
+    Publish the user's counts and the totals as a retained message, so their
+    screen can redraw without asking the API.  Called with counter_lock held,
+    which keeps the messages for a user in the order the counts changed.
+    """
+    payload = stats_for(username)
+    del payload["user"]
+    publisher.publish(f"{MQTT_TOPIC}/stats/{username}", json.dumps(payload, separators=(",", ":")), retain=True)
 
-def get_user_stats(username: str):
-    tea_count = count_lines_in_file(Path(f"data/{username}/tea.txt"))
-    coffee_count = count_lines_in_file(Path(f"data/{username}/coffee.txt"))
-    return {"tea": tea_count, "coffee": coffee_count}
+def publish_all_stats():
+    """
+    Publish every user's stats, at the pace the publisher drains them.  There
+    can be more users than the publisher queues, and a message that doesn't
+    fit would be dropped.
+    """
+    with counter_lock:
+        catch_up()
+        usernames = list(user_counts)
+    for i, username in enumerate(usernames):
+        if not publisher.wait_for_room():
+            log("stats_not_published", level="warning", users=len(usernames) - i, reason="queue_full")
+            return
+        # The lock is only held per message, so requests aren't kept waiting
+        with counter_lock:
+            catch_up()
+            publish_stats(username)
+
+def load_event_ids():
+    """Read any ids added to the file since we last looked, by us or another worker"""
+    global event_ids_offset
+    if not EVENT_IDS_FILE.exists():
+        return
+    with open(EVENT_IDS_FILE, "rb") as f:
+        f.seek(event_ids_offset)
+        data = f.read()
+    complete = data.rfind(b"\n") + 1
+    seen_event_ids.update(line.strip() for line in data[:complete].decode().splitlines() if line.strip())
+    event_ids_offset += complete
+
+def add_bulk_events(events: list[tuple[str | None, str, str, datetime]]) -> tuple[list, dict, list]:
+    """
+    Store a batch of past (event id, username, drink type, timestamp) and count
+    them.  Events whose id has been seen before are skipped.  Returns the
+    events that were stored, the stats afterwards for every user in the batch
+    and the celebrations the new drinks earned.
+    """
+    # A device only sends its own user's clicks, so holding the users' locks
+    # is enough to stop two copies of a resent batch both getting through,
+    # and batches for other users don't wait
+    users = {username for _, username, _, _ in events}
+    with writing(*users):
+        with event_ids_lock:
+            load_event_ids()
+            new_events = []
+            batch_ids = set()
+            for event_id, username, drink_type, timestamp in events:
+                if event_id is not None and (event_id in seen_event_ids or event_id in batch_ids):
+                    continue
+                if event_id is not None:
+                    batch_ids.add(event_id)
+                new_events.append((username, drink_type, timestamp))
+
+        if not new_events:
+            with counter_lock:
+                catch_up()
+                return [], {username: stats_for(username) for username in users}, []
+
+        with span("append_many"):
+            storage.append_many(new_events)
+        with counter_lock:
+            written = journal.append([
+                (username, drink_type, 1, int(timestamp.timestamp()))
+                for username, drink_type, timestamp in new_events
+            ])
+            # The rules are O(rules) per drink, so a batch crossing a
+            # milestone celebrates it like single drinks would
+            celebrations = catch_up(celebrate=written)
+            for username in {username for username, _, _ in new_events}:
+                publish_stats(username)
+            stats = {username: stats_for(username) for username in users}
+
+        if batch_ids:
+            STATE_DIR.mkdir(exist_ok=True, parents=True)
+            # One O_APPEND write, which other workers never see half of
+            fd = os.open(EVENT_IDS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, "".join(f"{event_id}\n" for event_id in batch_ids).encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with event_ids_lock:
+                seen_event_ids.update(batch_ids)
+
+    return new_events, stats, celebrations
+
+def check_counter_index() -> list[str]:
+    """Compare the counter index against storage, returns a list of mismatches"""
+    mismatches = []
+    # Stop the writers so storage and the journal agree while we compare
+    with FileLock(WRITERS_LOCK):
+        stored = storage.counts()
+        with counter_lock:
+            catch_up()
+            indexed_counts = {user: dict(counts) for user, counts in user_counts.items()}
+
+    for user in sorted(set(stored) | set(indexed_counts)):
+        indexed = indexed_counts.get(user, {"tea": 0, "coffee": 0})
+        for drink_type in ("tea", "coffee"):
+            on_disk = stored.get(user, {}).get(drink_type, 0)
+            if indexed[drink_type] != on_disk:
+                mismatches.append(f"{user} {drink_type}: index has {indexed[drink_type]}, files have {on_disk}")
+    return mismatches
 
-def get_all_stats(curr_user=None):
-    all_data = {
-        "user": curr_user,
-        "all_tea": 0,
-        "all_coffee": 0
-    }
+def get_last_drink_info(username: str) -> tuple:
+    """Get the last drink type and timestamp"""
+    return storage.last_drink(username)
 
-    for user in os.listdir("data"):
-        user_data = get_user_stats(user)
-        all_data["all_coffee"] += user_data["coffee"]
-        all_data["all_tea"] += user_data["tea"]
+def get_all_stats(curr_user=None):
+    with counter_lock:
+        all_data = {
+            "user": curr_user,
+            "all_tea": total_counts["tea"],
+            "all_coffee": total_counts["coffee"]
+        }
 
-        if user == curr_user:
-            all_data["user_coffee"] = user_data["coffee"]
-            all_data["user_tea"] = user_data["tea"]
+        if curr_user in user_counts:
+            all_data["user_coffee"] = user_counts[curr_user]["coffee"]
+            all_data["user_tea"] = user_counts[curr_user]["tea"]
     
     return all_data
 
-def is_prime(n: int) -> bool:
-    """Check if a number is prime."""
-    if n < 2:
-        return False
-    if n in (2, 3):
-        return True
-    if n % 2 == 0 or n % 3 == 0:
-        return False
-    i = 5
-    while i * i <= n:
-        if n % i == 0 or n % (i + 2) == 0:
-            return False
-        i += 6
-    return True
-
-def are_twin_primes(a: int, b: int) -> bool:
-    """Check if two numbers are twin primes."""
-    return abs(a - b) == 2 and is_prime(a) and is_prime(b)
+def send_celebrations(celebrations: list):
+    for target, message in celebrations:
+        if target == "all":
+            broadcast_celebration(message)
+        else:
+            send_celebration_to_screen(message, targets=[target])
 
-def celebrate_twin_primes(user):
-    user_stats = get_user_stats(user)
-    print(user_stats)
-    if are_twin_primes(user_stats["tea"], user_stats["coffee"]):
-        send_celebration_to_screen("Your teas and coffees are twin primes !!", targets=[user])
-
-def check_celebrations():
-    all_stats = get_all_stats()
-    
-    if all_stats["all_tea"] in MILESTONES:
-        broadcast_celebration(f"WOOO!11!11 MATTA HAVE HAD {all_stats['all_tea']} teas!")
-    
-    if all_stats["all_coffee"] in MILESTONES:
-        broadcast_celebration(f"WOOO!11!11 MATTA HAVE HAD {all_stats['all_coffee']} coffees!")
+class DrinkEvent(BaseModel):
+    # Set by devices replaying an offline queue, so a resent event is only counted once
+    id: str | None = None
+    user: str = Field(pattern=r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+    drink: Literal["tea", "coffee"]
+    timestamp: datetime
 
 class MessageRequest(BaseModel):
     users: List[str] | Literal["all"] # can be "all" or a list of usernames
     message: str
 
 @app.post("/{username}/coffee")
-def register_coffee(username: str):
-    init_user(username)
-    increment_coffee(username)
-    git_success = git_commit_and_push(username, "coffee")
-    check_celebrations()
-    celebrate_twin_primes(username)
+async def register_coffee(username: str, background_tasks: BackgroundTasks):
+    await asyncio.to_thread(init_user, username)
+    stats, celebrations = await asyncio.to_thread(increment_coffee, username)
+    committer.submit(username, "coffee")
+    background_tasks.add_task(send_celebrations, celebrations)
 
     return {
         "user": username,
         "message": "coffee registered!",
-        "git_push": "success"  if git_success else "failed"
+        "git_push": "queued",
+        "stats": stats
     }
 
 @app.post("/{username}/tea")
-def register_tea(username: str):
-    init_user(username)
-    increment_tea(username)
-    git_success = git_commit_and_push(username, "tea")
-    check_celebrations()
-    celebrate_twin_primes(username)
+async def register_tea(username: str, background_tasks: BackgroundTasks):
+    await asyncio.to_thread(init_user, username)
+    stats, celebrations = await asyncio.to_thread(increment_tea, username)
+    committer.submit(username, "tea")
+    background_tasks.add_task(send_celebrations, celebrations)
 
     return {
         "user": username,
         "message": "tea registered!",
-        "git_push": "success"  if git_success else "failed"
+        "git_push": "queued",
+        "stats": stats
+    }
+
+@app.post("/events/bulk")
+async def register_bulk_events(events: List[DrinkEvent], background_tasks: BackgroundTasks):
+    """Backfill or replay many drinks at once, e.g. paper tallies or a device's offline queue"""
+    now = datetime.now(UTC)
+    batch = []
+    for i, event in enumerate(events):
+        # Timestamps without a timezone are taken to be UTC
+        timestamp = event.timestamp if event.timestamp.tzinfo else event.timestamp.replace(tzinfo=UTC)
+        # Allow for device clocks running a little fast
+        if timestamp > now + timedelta(minutes=5):
+            raise HTTPException(status_code=422, detail=f"Event {i} is in the future: {event.timestamp.isoformat()}")
+        batch.append((event.id, event.user, event.drink, timestamp))
+
+    batch.sort(key=lambda event: event[3])
+    stored, stats, celebrations = await asyncio.to_thread(add_bulk_events, batch)
+    background_tasks.add_task(send_celebrations, celebrations)
+    if not stored:
+        return {"accepted": 0, "duplicates": len(batch), "git_push": "skipped", "stats": stats}
+
+    for username in sorted({username for username, _, _ in stored}):
+        drinks = sum(1 for event in stored if event[0] == username)
+        committer.submit(username, f"{drinks} drink{'s' if drinks != 1 else ''} in bulk")
+
+    return {
+        "accepted": len(stored),
+        "duplicates": len(batch) - len(stored),
+        "git_push": "queued",
+        "stats": stats
     }
 
 @app.post("/send_message")
@@ -302,12 +706,16 @@ def send_message(req: MessageRequest):
         )
 
 @app.get("/stats/{username}")
-def get_stats(username: str):
-    user_dir = Path(f"data/{username}")
+def get_stats(username: str, request: Request, response: Response):
+    # Read before the stats, so a change in between can only make the ETag stale
+    etag = current_etag()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
 
     all_stats = get_all_stats(username)
 
-    if not user_dir.exists():
+    if "user_tea" not in all_stats:
         return {
             "user": username,
             "user_tea": 0,
@@ -319,10 +727,10 @@ def get_stats(username: str):
     return all_stats
 
 @app.post("/{username}/undo")
-def undo_last_drink(username: str):
-    init_user(username)
+async def undo_last_drink(username: str):
+    await asyncio.to_thread(init_user, username)
     
-    drink_type, last_time = get_last_drink_info(username)
+    drink_type, last_time, stats = await asyncio.to_thread(remove_last_drink, username, UNDO_WINDOW)
     
     if not drink_type or not last_time:
         return {
@@ -331,32 +739,93 @@ def undo_last_drink(username: str):
             "success": False
         }
     
-    now = datetime.now(UTC)
-    time_diff = now - last_time
-    
-    if time_diff.total_seconds() > 60:
+    if not stats and datetime.now(UTC) - last_time > UNDO_WINDOW:
         return {
             "user": username,
             "message": "Cannot undo - last drink was more than 1 minute ago",
             "success": False
         }
     
-    user_dir = Path(f"data/{username}")
-    file_path = user_dir / f"{drink_type}.txt"
-    
-    success = remove_last_line_from_file(file_path)
-    
-    if success:
-        git_success = git_commit_and_push(username, f"undo {drink_type}")
+    if stats:
+        committer.submit(username, f"undo {drink_type}")
         return {
             "user": username,
             "message": f"Successfully undid last {drink_type}",
             "success": True,
-            "git_push": "success" if git_success else "failed"
+            "git_push": "queued",
+            "stats": stats
         }
     else:
         return {
             "user": username,
             "message": "Failed to undo",
             "success": False
-        }
\ No newline at end of file
+        }
+
+@app.get("/check_stats")
+def check_stats():
+    mismatches = check_counter_index()
+    return {
+        "consistent": not mismatches,
+        "mismatches": mismatches
+    }
+
+@app.get("/git_status")
+def git_status():
+    return committer.status()
+
+@app.get("/export")
+def export_history(
+    request: Request,
+    format: Literal["csv", "ndjson"] = "csv",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    users: str | None = None,
+):
+    """Every drink in [since, until) for the given comma-separated users, or everyone, streamed"""
+    # Times without a zone are UTC, like everything else here
+    since = since.replace(tzinfo=UTC) if since and since.tzinfo is None else since
+    until = until.replace(tzinfo=UTC) if until and until.tzinfo is None else until
+
+    known = storage.users()
+    if users:
+        requested = {username.strip() for username in users.split(",") if username.strip()}
+        usernames = sorted(requested & set(known))
+    else:
+        usernames = sorted(known)
+
+    gzip = export.accepts_gzip(request.headers.get("accept-encoding", ""))
+    headers = {
+        "Content-Disposition": f'attachment; filename="teapot-export.{format}"',
+        "Vary": "Accept-Encoding",
+    }
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export.export(storage, usernames, format, since, until, gzip),
+        media_type=media_type,
+        headers=headers,
+    )
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/profiles")
+def list_profiles():
+    return {
+        "every": profiler.every,
+        "profiles": profiler.list()
+    }
+
+@app.get("/admin/profiles/{request_id}")
+def download_profile(request_id: str):
+    collapsed = profiler.collapsed(request_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="No profile kept for that request")
+    return Response(
+        collapsed,
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="profile-{request_id}.txt"'},
+    )
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+Long-lived MQTT connection for the API server.
+
+One paho client stays connected with its network loop in a background thread,
+and a sender thread drains a bounded queue of outbound messages into it.  A
+fan-out to many screens is then many PUBLISH packets on one connection rather
+than a connect/disconnect per message.
+"""
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from metrics import MQTT_FAILURES
+from tracing import log, span
+
+# Messages waiting for the broker beyond this are dropped
+MAX_QUEUED_MESSAGES = 1000
+# How long the sender waits for a (re)connection before dropping a message
+CONNECT_WAIT = 10.0
+
+class MqttPublisher:
+    def __init__(self, hostname: str, port: int = 1883, max_queued: int = MAX_QUEUED_MESSAGES):
+        self.hostname = hostname
+        self.port = port
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.connected = threading.Event()
+        self.client = None
+        self.thread = None
+
+    def start(self):
+        try:
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        except AttributeError:
+            # paho-mqtt < 2.0
+            self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.connect_async(self.hostname, self.port)
+        self.client.loop_start()
+
+        self.thread = threading.Thread(target=self.run, name="mqtt-publisher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Send whatever is queued, then disconnect"""
+        try:
+            self.queue.put((None, None, False), timeout=CONNECT_WAIT)
+        except queue.Full:
+            pass
+        if self.thread:
+            self.thread.join(timeout=CONNECT_WAIT)
+        if self.client:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        log("mqtt_connected", host=self.hostname, reason=str(reason_code))
+        self.connected.set()
+
+    def on_disconnect(self, client, userdata, *args):
+        log("mqtt_disconnected", level="warning", host=self.hostname)
+        self.connected.clear()
+
+    def publish(self, topic: str, payload: str, retain: bool = False) -> bool:
+        """Queue a message, False if the queue is full and it was dropped"""
+        try:
+            self.queue.put_nowait((topic, payload, retain))
+            return True
+        except queue.Full:
+            MQTT_FAILURES.inc(reason="queue_full")
+            log("mqtt_dropped", level="warning", topic=topic, reason="queue_full")
+            return False
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def wait_for_room(self, timeout: float = CONNECT_WAIT) -> bool:
+        """
+        Wait until the queue is at most half full, so a burst of messages can
+        be paced to what the broker takes.  False if it didn't drain in time.
+        """
+        deadline = time.monotonic() + timeout
+        while self.queue.qsize() >= self.queue.maxsize // 2:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def run(self):
+        while True:
+            topic, payload, retain = self.queue.get()
+            if topic is None:
+                return
+
+            if not self.connected.wait(timeout=CONNECT_WAIT):
+                MQTT_FAILURES.inc(reason="not_connected")
+                log("mqtt_dropped", level="warning", topic=topic, reason="not_connected")
+                continue
+
+            with span("mqtt_publish"):
+                info = self.client.publish(topic, payload=payload, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                MQTT_FAILURES.inc(reason="publish_failed")
+                log("mqtt_publish_failed", level="error", topic=topic, error=mqtt.error_string(info.rc))
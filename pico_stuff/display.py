@@ -38,6 +38,8 @@ class Display:
         )
         self.width = 240
         self.height = 240
+        # What the home screen is currently showing, None if something else is
+        self.home = None
     
     def draw_text_centred(self, y, text, color, bg_color=None, font_size=8):
         """Draw text centered horizontally at the given y position"""
@@ -88,6 +90,7 @@ class Display:
     
     def draw_tea_registered(self):
         """Display tea registered message with bitmap"""
+        self.home = None
         self.display.fill(BLACK)
         
         # Calculate centered position for 64x64 bitmap
@@ -103,6 +106,7 @@ class Display:
     
     def draw_coffee_registered(self):
         """Display coffee registered message with bitmap"""
+        self.home = None
         self.display.fill(BLACK)
         
         # Calculate centered position for 64x64 bitmap
@@ -119,6 +123,7 @@ class Display:
     
     def draw_undo(self):
         """Display undo message with bitmap"""
+        self.home = None
         self.display.fill(BLACK)
         
         # Calculate centered position for 64x64 bitmap
@@ -135,6 +140,10 @@ class Display:
     
     def home_screen(self, username, teas, coffees):
         """Display the home screen with drink counts and idle status"""
+        # Skip the full-screen redraw if it's already showing these counts
+        if self.home == (username, teas, coffees):
+            return
+        self.home = (username, teas, coffees)
         self.display.fill(BLACK)
         
         # Format username possessive correctly
@@ -157,6 +166,7 @@ class Display:
     
     def undo_failed(self):
         """Display undo failed message"""
+        self.home = None
         self.display.fill(BLACK)
         self.draw_text_centred(120, "UNDO NOT POSSIBLE", WHITE, font_size=8)
         self.draw_text_centred(130, "TOO LONG SINCE LAST DRINK", WHITE, font_size=8)
@@ -164,6 +174,7 @@ class Display:
     
     def welcome(self, username):
         """Display welcome message"""
+        self.home = None
         self.display.fill(BLACK)
         self.draw_text_centred(110, f"Welcome", WHITE, font_size=16)
         self.draw_text_centred(130, f"{capitalise(username)}!", WHITE, font_size=16)
@@ -171,9 +182,11 @@ class Display:
 
     def status(self, message):
         """Display status message at the top of the screen"""
+        self.home = None
         self.draw_text_centred(22, message, RED, font_size=8)
 
     def message(self, message, display_time=10):
+        self.home = None
         self.display.fill(BLACK)
         lines = []
         words = message.split(" ")
@@ -208,6 +221,7 @@ class Display:
         time.sleep(display_time)
 
     def celebrate(self, message, display_time=10):
+        self.home = None
         colours = [RED, ORANGE, YELLOW, GREEN, BLUE, INDIGO, VIOLET]
         self.display.fill(BLACK)
         
@@ -1,19 +1,30 @@
 from machine import Pin, SPI
 import time
 import network
+import ntptime
 import urequests
 from display import Display
 from mqtt import MQTTClient
+from outbox import Outbox, clock_is_set
 import json
 from setup import USER_NAME, SERVER_IP, PORT, MQTT_BROKER, MQTT_TOPIC
 
 API_URL = f"http://{SERVER_IP}:{PORT}"
 message_queue = []
 celebration_queue = []
+STATS_TOPIC = f"{MQTT_TOPIC}/stats/{USER_NAME}"
+latest_stats = None # retained stats pushed by the server
+stats_changed = False
+stats_etag = None # ETag of the last stats fetched over HTTP
 mqtt_client = None
 DEBOUNCE_TIME = 50 # ms
 LONG_PRESS = 1000 # ms
 DOUBLE_CLICK_WINDOW = 500 # ms
+RETRY_INTERVAL = 30000 # ms between attempts to send queued clicks
+STATS_REFRESH_INTERVAL = 300000 # ms between checks that our stats are current
+last_stats_refresh = 0
+outbox = None
+last_flush_attempt = 0
 
 def setup_mqtt():
     """Setup MQTT client and subscribe"""
@@ -25,6 +36,8 @@ def setup_mqtt():
         mqtt_client.connect()
         mqtt_client.subscribe(f"{MQTT_TOPIC}/all")
         mqtt_client.subscribe(f"{MQTT_TOPIC}/{USER_NAME}")
+        # Retained, so the current counts arrive as soon as we subscribe
+        mqtt_client.subscribe(STATS_TOPIC)
         print("MQTT connected and subscribed")
         return True
     except Exception as e:
@@ -33,9 +46,14 @@ def setup_mqtt():
 
 def mqtt_callback(topic, msg):
     """Handle incoming MQTT messages"""
+    global latest_stats, stats_changed
     try:
         data = json.loads(msg.decode())
-        if data.get("type") == "message":
+        if topic.decode() == STATS_TOPIC:
+            latest_stats = data
+            stats_changed = True
+            print(f"Received stats: {data}")
+        elif data.get("type") == "message":
             message_queue.append(data["message"])
             print(f"Received message: {data['message']}")
         elif data.get("type") == "celebration":
@@ -105,27 +123,104 @@ def setup_ethernet():
         screen.message(str(e))
         return False
 
-def send_click(drink_type: str):
-    """Send a click to the server"""
-    screen.status(f"Sending {drink_type}...")
+def setup_clock():
+    """Set the RTC to UTC so queued clicks keep the time they happened"""
     try:
-        url = f"{API_URL}/{USER_NAME}/{drink_type}"
-        print(f"Sending drink to: {url}")
-        
-        response = urequests.post(url)
-        result = response.json()
-        
-        print(f"Success! {result['message']}")
-        response.close()
+        ntptime.settime()
+        print(f"Clock set: {time.gmtime()}")
         return True
-        
     except Exception as e:
-        print(f"Error: {e}")
-        screen.message(f"Error: {str(e)}")
+        print(f"Failed to set clock: {e}")
         return False
 
+def flush_outbox():
+    """
+    Send queued clicks in batches, one request per batch.  Network errors and
+    server errors are retried later; clicks the server rejects are set aside.
+    """
+    global last_flush_attempt, latest_stats
+    last_flush_attempt = time.ticks_ms()
+    if not len(outbox):
+        return True
+    # Queued clicks need the real time before they can go
+    if not clock_is_set() and not setup_clock():
+        return False
+    outbox.date_events()
+
+    size = None
+    while len(outbox):
+        batch = outbox.batch(size) if size else outbox.batch()
+        try:
+            url = f"{API_URL}/events/bulk"
+            print(f"Sending {len(batch)} clicks to: {url}")
+
+            response = urequests.post(url, json=batch)
+            if 400 <= response.status_code < 500:
+                # Retrying won't help.  Send the rest one at a time to find
+                # the click that was refused
+                print(f"Rejected: {response.status_code} {response.text}")
+                reason = f"{response.status_code} {response.text}"
+                response.close()
+                if len(batch) == 1:
+                    outbox.set_aside(reason)
+                size = 1
+                continue
+            if response.status_code != 200:
+                print(f"Failed: {response.status_code} {response.text}")
+                response.close()
+                return False
+            result = response.json()
+            response.close()
+
+            # Anything the server already had is reported as a duplicate
+            print(f"Success! {result['accepted']} accepted, {result['duplicates']} duplicates")
+            outbox.sent(len(batch))
+            # The response carries our new counts, so no need to ask for them
+            if USER_NAME in result["stats"]:
+                latest_stats = result["stats"][USER_NAME]
+
+        except Exception as e:
+            print(f"Error: {e}")
+            return False
+    return True
+
+def send_click(drink_type: str):
+    """Send a click to the server, or queue it in flash if the server can't be reached"""
+    global latest_stats
+    screen.status(f"Sending {drink_type}...")
+    # Anything still queued goes first, and if that fails the server is down anyway
+    if flush_outbox():
+        try:
+            url = f"{API_URL}/{USER_NAME}/{drink_type}"
+            print(f"Sending {drink_type} to: {url}")
+
+            response = urequests.post(url)
+            if response.status_code == 200:
+                result = response.json()
+                response.close()
+                print(f"Success! {result['message']}")
+                latest_stats = result["stats"]
+                return True
+            print(f"Failed: {response.status_code} {response.text}")
+            response.close()
+            if response.status_code < 500:
+                screen.message(f"Failed: {response.status_code}")
+                return False
+        except Exception as e:
+            print(f"Error: {e}")
+
+    outbox.add(drink_type)
+    screen.status("Offline, saved for later")
+    return True
+
 def send_undo():
     """Send an undo to the server"""
+    global latest_stats
+    # A click that never reached the server can just be dropped
+    if outbox.pop_last():
+        print("Undid a queued click")
+        return True
+
     screen.status("Sending undo...")
     try:
         url = f"{API_URL}/{USER_NAME}/undo"
@@ -135,6 +230,7 @@ def send_undo():
         result = response.json()
         if result["success"]:
             print(f"Success! {result['message']}")
+            latest_stats = result["stats"]
             response.close()
             return True
         else:
@@ -148,19 +244,42 @@ def send_undo():
         return False
 
 def get_user_data():
+    """Fetch our stats, the data is None if nothing has changed since the last fetch"""
+    global stats_etag
     try:
         url = f"{API_URL}/stats/{USER_NAME}"
-        response = urequests.get(url)
+        headers = {"If-None-Match": stats_etag} if stats_etag else {}
+        response = urequests.get(url, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            return True, None
         result = response.json()
+        stats_etag = response.headers.get("etag") or response.headers.get("ETag")
+        response.close()
         return True, result
     except Exception as e:
         print(f"error: {e}")
         return False, {}
 
-def update_home_screen():
+def refresh_stats():
+    """Check our stats with the API in case an MQTT update was missed"""
+    global latest_stats, last_stats_refresh
+    last_stats_refresh = time.ticks_ms()
     user_success, user_data = get_user_data()
-    if user_success:
-        screen.home_screen(USER_NAME, user_data["user_tea"], user_data["user_coffee"])
+    if user_success and user_data is not None:
+        latest_stats = user_data
+        # Redraws only if the counts actually changed
+        update_home_screen()
+
+def update_home_screen():
+    global latest_stats
+    # Only ask the API if the server hasn't pushed our stats yet
+    if latest_stats is None:
+        user_success, user_data = get_user_data()
+        if not user_success or user_data is None:
+            return
+        latest_stats = user_data
+    screen.home_screen(USER_NAME, latest_stats["user_tea"], latest_stats["user_coffee"])
 
 
 if __name__ == "__main__":
@@ -168,6 +287,7 @@ if __name__ == "__main__":
 
     setup_screen()
     setup_switch()
+    outbox = Outbox(USER_NAME)
 
     # Connect to api
     while not setup_ethernet():
@@ -175,6 +295,8 @@ if __name__ == "__main__":
         while True:
             time.sleep(1)
 
+    setup_clock()
+
     # connect to MQTT
     if not setup_mqtt():
         screen.message("MQTT setup failed")
@@ -182,6 +304,8 @@ if __name__ == "__main__":
             time.sleep(1)
 
     screen.welcome(USER_NAME)
+    # Send anything clicked while the server was unreachable before a restart
+    flush_outbox()
     update_home_screen()
 
     # Main loop
@@ -191,6 +315,14 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"MQTT error: {e}")
         print(f"messages: {message_queue}")
+        if stats_changed:
+            stats_changed = False
+            update_home_screen()
+        if time.ticks_diff(time.ticks_ms(), last_stats_refresh) > STATS_REFRESH_INTERVAL:
+            refresh_stats()
+        if len(outbox) and time.ticks_diff(time.ticks_ms(), last_flush_attempt) > RETRY_INTERVAL:
+            if flush_outbox():
+                update_home_screen()
         if message_queue:
             screen.message(message_queue.pop(0))
             update_home_screen()
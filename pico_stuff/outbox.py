@@ -0,0 +1,131 @@
+"""
+Offline queue of clicks, kept in flash so nothing is lost if the server is
+down or the Pico restarts.  Each click gets an id that is unique across
+reboots, so the server can drop any event it has already stored when a
+batch is resent.
+
+Clicks queued before NTP has set the clock are stamped with ticks_ms()
+instead, and given their time once the clock is set.  Clicks that can't be
+dated, or that the server rejects, are set aside in rejected.txt rather than
+blocking the queue.
+"""
+import json
+import os
+import time
+
+OUTBOX_FILE = "outbox.txt"
+BOOT_FILE = "boot.txt"
+REJECTED_FILE = "rejected.txt"
+MAX_BATCH = 50 # events per request
+
+def file_exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+def next_boot_number():
+    """Count restarts in flash so ids from different boots never collide"""
+    boot = 0
+    if file_exists(BOOT_FILE):
+        with open(BOOT_FILE, "r") as f:
+            boot = int(f.read().strip() or 0)
+    boot += 1
+    with open(BOOT_FILE, "w") as f:
+        f.write(str(boot))
+    return boot
+
+def clock_is_set():
+    # The RTC starts in 2021 until NTP sets it
+    return time.gmtime()[0] >= 2025
+
+def utc_timestamp(seconds=None):
+    year, month, day, hour, minute, second = time.gmtime(seconds)[:6]
+    return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{second:02d}Z"
+
+class Outbox:
+    def __init__(self, user_name):
+        self.user_name = user_name
+        self.boot = next_boot_number()
+        self.seq = 0
+        self.events = []
+
+        if file_exists(OUTBOX_FILE):
+            with open(OUTBOX_FILE, "r") as f:
+                for line in f:
+                    if line.strip():
+                        self.events.append(json.loads(line))
+        print(f"Outbox has {len(self.events)} unsent clicks")
+
+    def __len__(self):
+        return len(self.events)
+
+    def save(self):
+        with open(OUTBOX_FILE, "w") as f:
+            for event in self.events:
+                f.write(json.dumps(event) + "\n")
+
+    def add(self, drink_type):
+        """Record a click in flash straight away"""
+        self.seq += 1
+        event = {
+            "id": f"{self.user_name}-{self.boot}-{self.seq}",
+            "user": self.user_name,
+            "drink": drink_type,
+        }
+        if clock_is_set():
+            event["timestamp"] = utc_timestamp()
+        else:
+            # Only means anything until the next reboot
+            event["boot"] = self.boot
+            event["ticks"] = time.ticks_ms()
+        self.events.append(event)
+        with open(OUTBOX_FILE, "a") as f:
+            f.write(json.dumps(event) + "\n")
+        return event
+
+    def pop_last(self):
+        """Take back the newest unsent click, for undo"""
+        if not self.events:
+            return None
+        event = self.events.pop()
+        self.save()
+        return event
+
+    def date_events(self):
+        """Give clicks queued before the clock was set their time, call once it is"""
+        now = time.time()
+        now_ticks = time.ticks_ms()
+        undated = []
+        for event in self.events:
+            if "timestamp" in event:
+                continue
+            if event["boot"] == self.boot:
+                event["timestamp"] = utc_timestamp(now - time.ticks_diff(now_ticks, event["ticks"]) // 1000)
+                del event["boot"], event["ticks"]
+            else:
+                undated.append(event)
+        for event in undated:
+            self.events.remove(event)
+            self.reject(event, "queued before the clock was set, then the Pico restarted")
+        self.save()
+
+    def batch(self, size=MAX_BATCH):
+        return self.events[:size]
+
+    def sent(self, count):
+        """Forget the first count events once the server has them"""
+        self.events = self.events[count:]
+        self.save()
+
+    def reject(self, event, reason):
+        """Keep an event the server won't take where it can be looked at, out of the queue"""
+        print(f"Setting aside {event['id']}: {reason}")
+        with open(REJECTED_FILE, "a") as f:
+            f.write(json.dumps({"event": event, "reason": reason}) + "\n")
+
+    def set_aside(self, reason):
+        """Take the first event out of the queue for good"""
+        self.reject(self.events.pop(0), reason)
+        self.save()
@@ -6,4 +6,4 @@ PORT = None
 
 # MQTT setup
 MQTT_BROKER = SERVER_IP
-MQTT_TOPIC = b"teacounter/messages"
+MQTT_TOPIC = "teacounter"
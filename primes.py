@@ -0,0 +1,73 @@
+"""
+Shared prime sieve for the prime-based celebrations.
+
+Flags are kept for odd numbers only (index i is the number 2i + 1) in a
+bytearray, so a lookup is one index.  When a count passes the end of the
+sieve it is extended by sieving just the new chunk against the primes already
+found, rather than starting again.
+"""
+import threading
+from math import isqrt
+
+# Numbers covered by each extension, at least
+CHUNK = 1 << 16
+
+class PrimeSieve:
+    def __init__(self, bound: int = CHUNK):
+        # The number 1 is not prime
+        self.sieve = bytearray(1)
+        self.lock = threading.Lock()
+        self.extend(bound)
+
+    @property
+    def bound(self) -> int:
+        """Every number below this has been sieved"""
+        return 2 * len(self.sieve)
+
+    def extend(self, bound: int):
+        """Sieve every number below bound"""
+        with self.lock:
+            self._extend(bound)
+
+    def _extend(self, bound: int):
+        old_len = len(self.sieve)
+        new_len = (bound + 1) // 2
+        if new_len <= old_len:
+            return
+
+        # Make sure we already know every prime up to the square root of the new bound
+        limit = isqrt(2 * new_len - 1)
+        if limit >= 2 * old_len:
+            self._extend(limit + 1)
+            old_len = len(self.sieve)
+
+        segment = bytearray(b"\x01") * (new_len - old_len)
+        segment_start = 2 * old_len + 1
+        for i in range(1, limit // 2 + 1):
+            if not self.sieve[i]:
+                continue
+            p = 2 * i + 1
+            # First odd multiple of p that is in the new segment and not below p squared
+            start = max(p * p, (segment_start + p - 1) // p * p)
+            if start % 2 == 0:
+                start += p
+            index = (start - 1) // 2 - old_len
+            if index < len(segment):
+                segment[index::p] = bytes(len(range(index, len(segment), p)))
+
+        self.sieve += segment
+
+    def is_prime(self, n: int) -> bool:
+        if n < 2:
+            return False
+        if n % 2 == 0:
+            return n == 2
+        if n >= self.bound:
+            self.extend(max(n + 1, self.bound + CHUNK))
+        return self.sieve[n >> 1] == 1
+
+sieve = PrimeSieve()
+
+def is_prime(n: int) -> bool:
+    """Check if a number is prime."""
+    return sieve.is_prime(n)
@@ -0,0 +1,114 @@
+"""
+Opt-in sampling profiler for individual requests.
+
+Every Nth request is profiled by a background thread that snapshots the
+stacks of every other thread at a fixed interval until the request finishes.
+Sampling all threads catches the work done in asyncio.to_thread workers as
+well as on the event loop, at the cost of also catching whatever concurrent
+requests were doing.  Only one request is profiled at a time.
+
+Profiles are kept in memory, the last K of them, as collapsed stacks
+("outer;inner;leaf count" per line), which flamegraph.pl and speedscope
+read directly.
+"""
+import sys
+import threading
+from collections import Counter, deque
+from datetime import datetime, UTC
+
+DEFAULT_INTERVAL = 0.005
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename.rsplit("/", 1)[-1]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+def collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class Sampler:
+    """Samples every thread's stack until stopped"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        # Sample straight away, so even a request shorter than the interval shows up
+        while True:
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[collapse(frame)] += 1
+            if self.stopped.wait(self.interval):
+                return
+
+class RequestProfiler:
+    def __init__(self, every: int = 0, keep: int = 20, interval: float = DEFAULT_INTERVAL):
+        # 0 turns profiling off
+        self.every = every
+        self.interval = interval
+        self.profiles = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = False
+
+    def maybe_start(self) -> Sampler | None:
+        """A running sampler if this request should be profiled, otherwise None"""
+        if self.every <= 0:
+            return None
+        with self.lock:
+            self.requests += 1
+            if self.active or self.requests < self.every:
+                return None
+            self.requests = 0
+            self.active = True
+        sampler = Sampler(self.interval)
+        sampler.start()
+        return sampler
+
+    def finish(self, sampler: Sampler, request_id: str, method: str, path: str, duration: float):
+        sampler.stop()
+        profile = {
+            "request_id": request_id,
+            "method": method,
+            "path": path,
+            "time": datetime.now(UTC).isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            "samples": sampler.samples,
+            "interval_ms": self.interval * 1000,
+            "stacks": sampler.stacks,
+        }
+        with self.lock:
+            self.profiles.append(profile)
+            self.active = False
+
+    def list(self) -> list[dict]:
+        with self.lock:
+            return [
+                {key: value for key, value in profile.items() if key != "stacks"}
+                for profile in reversed(self.profiles)
+            ]
+
+    def collapsed(self, request_id: str) -> str | None:
+        """The profile in collapsed stack format, or None if it isn't kept"""
+        with self.lock:
+            for profile in self.profiles:
+                if profile["request_id"] == request_id:
+                    return "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].most_common())
+        return None
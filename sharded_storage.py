@@ -0,0 +1,123 @@
+"""
+Sharded layout of the text storage engine, for data directories with
+thousands of users.
+
+    data/users.txt                   every username, one per line
+    data/<shard>/<username>/tea.txt  the usual one timestamp per line
+
+The shard is the first two hex digits of the SHA-1 of the username, so no
+directory holds more than a few users.  The manifest is read once at startup
+and kept in memory, so init_user() for a known user costs no syscalls and
+listing users never walks the tree.
+
+A data directory with a users.txt is sharded; main.py picks the layout by
+looking for it.  Convert an existing flat data/ directory in place with:
+
+    python sharded_storage.py migrate [data_dir]
+"""
+import hashlib
+import os
+import sys
+import threading
+from pathlib import Path
+
+from storage import TextStorage
+
+MANIFEST = "users.txt"
+
+def shard(username: str) -> str:
+    return hashlib.sha1(username.encode()).hexdigest()[:2]
+
+def is_sharded(data_dir: Path) -> bool:
+    return (Path(data_dir) / MANIFEST).exists()
+
+def open_text_storage(data_dir: Path) -> TextStorage:
+    """Whichever text layout data_dir is in"""
+    if is_sharded(data_dir):
+        return ShardedTextStorage(data_dir)
+    return TextStorage(data_dir)
+
+class ShardedTextStorage(TextStorage):
+    def __init__(self, root: Path = Path("data")):
+        super().__init__(root)
+        self.manifest = self.root / MANIFEST
+        self.lock = threading.Lock()
+        self.known: set[str] = set()
+        # How much of the manifest has been read into known
+        self.manifest_offset = 0
+        self.load_manifest()
+
+    def load_manifest(self):
+        """Read any names added since we last looked, by us or another worker"""
+        if not self.manifest.exists():
+            return
+        with open(self.manifest, "rb") as f:
+            f.seek(self.manifest_offset)
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        self.known.update(line.strip() for line in data[:complete].decode().splitlines() if line.strip())
+        self.manifest_offset += complete
+
+    def user_dir(self, username: str) -> Path:
+        return self.root / shard(username) / username
+
+    def init_user(self, username: str):
+        if username in self.known:
+            return
+
+        with self.lock:
+            self.load_manifest()
+            if username in self.known:
+                return
+            super().init_user(username)
+            with open(self.manifest, "a") as f:
+                f.write(f"{username}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.known.add(username)
+
+    def users(self) -> list[str]:
+        with self.lock:
+            self.load_manifest()
+            return sorted(self.known)
+
+    def paths(self, username: str) -> list[str]:
+        return [f"{self.user_dir(username)}/", str(self.manifest)]
+
+def migrate_to_sharded(data_dir: Path):
+    """Move a flat data/<user>/ tree into shards in place and write the manifest"""
+    data_dir = Path(data_dir)
+    if is_sharded(data_dir):
+        raise ValueError(f"{data_dir} is already sharded")
+
+    users = sorted(
+        name for name in os.listdir(data_dir)
+        if not name.startswith(".") and (data_dir / name).is_dir()
+    )
+
+    # Stage the shards beside the users first, so a user whose name looks
+    # like a shard can't collide with one
+    staging = data_dir / ".sharding"
+    staging.mkdir()
+    for username in users:
+        (staging / shard(username)).mkdir(exist_ok=True)
+        os.rename(data_dir / username, staging / shard(username) / username)
+    for shard_name in os.listdir(staging):
+        os.rename(staging / shard_name, data_dir / shard_name)
+    staging.rmdir()
+
+    # Written last, so an interrupted migration is never mistaken for a finished one
+    with open(data_dir / MANIFEST, "w") as f:
+        f.write("".join(f"{username}\n" for username in users))
+        f.flush()
+        os.fsync(f.fileno())
+
+    print(f"Moved {len(users)} users into shards under {data_dir}")
+    return ShardedTextStorage(data_dir)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python sharded_storage.py migrate [data_dir]")
+        sys.exit(1)
+    data_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("data")
+    migrate_to_sharded(data_dir)
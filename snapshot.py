@@ -0,0 +1,75 @@
+"""
+Snapshots of the in-memory counter index, so a restart doesn't have to read
+the whole drink history again.
+
+A snapshot is one JSON file in the state directory holding the counts,
+per-day rollups, streaks and prime sieve size as they were at a position in
+the change journal.  At startup the server loads it and replays only the
+journal written after that position, so a restart costs time in proportion
+to the activity since the last snapshot rather than to the whole history.
+Celebrations are worked out from the counts and streaks, and the last drink
+is asked of the storage engine when it's needed, so that is everything the
+index holds.  The event log engine is the exception to the cheap restart:
+it keeps every drink in memory and reads its whole log at startup anyway.
+
+The file is replaced atomically, so a crash while writing leaves the previous
+snapshot in place.  A snapshot is only used when it was taken from the same
+storage and the same journal file, otherwise the index is rebuilt from
+scratch.  After changing the data behind the server's back (restoring a
+backup, editing files by hand) delete it with:
+
+    python snapshot.py clear [state_dir]
+"""
+import json
+import os
+import sys
+from pathlib import Path
+
+from tracing import log
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = "snapshot.json"
+
+def write_snapshot(path: Path, state: dict):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Every worker may write snapshots, so each gets its own temporary file
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "w") as f:
+        json.dump({"version": SNAPSHOT_VERSION, **state}, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+    # Make the rename itself durable
+    fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_snapshot(path: Path) -> dict | None:
+    """The snapshot, or None if there isn't a usable one"""
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log("snapshot_unreadable", level="warning", path=str(path), error=str(e))
+        return None
+    if state.get("version") != SNAPSHOT_VERSION:
+        log("snapshot_ignored", reason="version", version=state.get("version"))
+        return None
+    return state
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "clear":
+        print("usage: python snapshot.py clear [state_dir]")
+        sys.exit(1)
+    state_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("state")
+    try:
+        os.remove(state_dir / SNAPSHOT_FILE)
+        print(f"Removed {state_dir / SNAPSHOT_FILE}, the next start rebuilds the index")
+    except FileNotFoundError:
+        print(f"There is no snapshot in {state_dir}")
@@ -0,0 +1,169 @@
+"""
+SQLite storage engine.
+
+Drinks live in a single drinks(user, type, ts) table in WAL mode, indexed on
+(user, ts) and (type, ts), so stats, the last drink and undo are each one
+indexed query instead of a walk over the data directory.
+
+Copy an existing data/ directory into a database with:
+
+    python sqlite_storage.py migrate [data_dir] [db_path]
+"""
+import sqlite3
+import sys
+import threading
+from datetime import datetime, UTC
+from pathlib import Path
+
+from sharded_storage import open_text_storage
+from storage import DRINKS, Storage, epoch_bound, parse_timestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS drinks (
+    user TEXT NOT NULL,
+    type TEXT NOT NULL,
+    ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS drinks_user_ts ON drinks (user, ts);
+CREATE INDEX IF NOT EXISTS drinks_type_ts ON drinks (type, ts);
+"""
+
+# Rows read per query when iterating over a user's drinks
+EVENTS_PAGE = 1000
+# Larger than any rowid or timestamp
+MAX_INTEGER = 2**63 - 1
+
+class SqliteStorage(Storage):
+    def __init__(self, path: Path = Path("teapot.db")):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Every insert is on disk before the request returns
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(SCHEMA)
+
+    def query(self, sql: str, params: tuple = ()) -> list:
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def init_user(self, username: str):
+        # Users only exist through their drinks
+        pass
+
+    def append(self, username: str, drink_type: str, timestamp: datetime):
+        self.query(
+            "INSERT INTO drinks (user, type, ts) VALUES (?, ?, ?)",
+            (username, drink_type, int(timestamp.timestamp())),
+        )
+
+    def append_many(self, events: list[tuple[str, str, datetime]]):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO drinks (user, type, ts) VALUES (?, ?, ?)",
+                [(username, drink_type, int(timestamp.timestamp())) for username, drink_type, timestamp in events],
+            )
+            self.db.execute("COMMIT")
+
+    def remove_last(self, username: str, drink_type: str) -> bool:
+        with self.lock:
+            cursor = self.db.execute(
+                """
+                DELETE FROM drinks WHERE rowid = (
+                    SELECT rowid FROM drinks WHERE user = ? AND type = ?
+                    ORDER BY ts DESC, rowid DESC LIMIT 1
+                )
+                """,
+                (username, drink_type),
+            )
+            return cursor.rowcount > 0
+
+    def last_drink(self, username: str) -> tuple:
+        rows = self.query(
+            "SELECT type, ts FROM drinks WHERE user = ? ORDER BY ts DESC, rowid DESC LIMIT 1",
+            (username,),
+        )
+        if not rows:
+            return None, None
+        drink_type, ts = rows[0]
+        return drink_type, datetime.fromtimestamp(ts, UTC)
+
+    def users(self) -> list[str]:
+        return [user for (user,) in self.query("SELECT DISTINCT user FROM drinks")]
+
+    def user_counts(self, username: str) -> dict[str, int]:
+        counts = {drink_type: 0 for drink_type in DRINKS}
+        rows = self.query("SELECT type, COUNT(*) FROM drinks WHERE user = ? GROUP BY type", (username,))
+        for drink_type, count in rows:
+            counts[drink_type] = count
+        return counts
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        counts = {}
+        for user, drink_type, count in self.query("SELECT user, type, COUNT(*) FROM drinks GROUP BY user, type"):
+            counts.setdefault(user, {drink_type: 0 for drink_type in DRINKS})[drink_type] = count
+        return counts
+
+    def iter_events(self, username: str, since: datetime = None, until: datetime = None):
+        # A page at a time, keyed on (ts, rowid), so a long history is never
+        # all in memory and other queries get the connection in between.  The
+        # first key is just below since, so the (user, ts) index seeks to it.
+        ts, rowid = (epoch_bound(since) - 1, MAX_INTEGER) if since else (-1, -1)
+        until = epoch_bound(until) if until else MAX_INTEGER
+        while True:
+            rows = self.query(
+                """
+                SELECT ts, rowid, type FROM drinks
+                WHERE user = ? AND (ts, rowid) > (?, ?) AND ts < ?
+                ORDER BY ts, rowid LIMIT ?
+                """,
+                (username, ts, rowid, until, EVENTS_PAGE),
+            )
+            for ts, rowid, drink_type in rows:
+                yield datetime.fromtimestamp(ts, UTC), drink_type
+            if len(rows) < EVENTS_PAGE:
+                return
+
+    def sync(self):
+        # Fold the WAL back into the main file so committing it captures everything
+        self.query("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def paths(self, username: str) -> list[str]:
+        return [str(self.path)]
+
+def migrate_from_text(data_dir: Path, db_path: Path):
+    """One-off copy of a data/ tree, flat or sharded, into a new database"""
+    if Path(db_path).exists():
+        raise ValueError(f"{db_path} already exists, refusing to migrate into it")
+    source = open_text_storage(data_dir)
+    db = SqliteStorage(db_path)
+
+    rows = []
+    for username in source.users():
+        for drink_type in DRINKS:
+            drink_file = source.drink_file(username, drink_type)
+            if not drink_file.exists():
+                continue
+            with open(drink_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        rows.append((username, drink_type, int(parse_timestamp(line).timestamp())))
+
+    rows.sort(key=lambda row: row[2])
+    with db.lock:
+        db.db.execute("BEGIN")
+        db.db.executemany("INSERT INTO drinks (user, type, ts) VALUES (?, ?, ?)", rows)
+        db.db.execute("COMMIT")
+    db.sync()
+
+    print(f"Migrated {len(rows)} drinks into {db_path}")
+    return db
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python sqlite_storage.py migrate [data_dir] [db_path]")
+        sys.exit(1)
+    data_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path("data")
+    db_path = Path(sys.argv[3]) if len(sys.argv) > 3 else Path("teapot.db")
+    migrate_from_text(data_dir, db_path)
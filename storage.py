@@ -0,0 +1,314 @@
+"""
+Storage engines for drink events.
+
+Every engine stores the same thing, a timestamped tea or coffee for a user,
+and main.py only talks to them through the Storage interface below.  The
+original layout (one text file per user per drink) lives here as TextStorage.
+"""
+import heapq
+import math
+import os
+from datetime import datetime, UTC
+from pathlib import Path
+
+DRINKS = ("tea", "coffee")
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Comfortably more than one timestamp line, so the tail reader usually needs one read
+TAIL_BLOCK_SIZE = 256
+
+def format_timestamp(timestamp: datetime) -> str:
+    return timestamp.astimezone(UTC).strftime(TIMESTAMP_FORMAT)
+
+def parse_timestamp(text: str) -> datetime:
+    return datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+
+def latest_drink(last_tea_time, last_coffee_time) -> tuple:
+    """Pick whichever of the last tea and last coffee happened most recently"""
+    if last_tea_time and last_coffee_time:
+        if last_tea_time > last_coffee_time:
+            return "tea", last_tea_time
+        else:
+            return "coffee", last_coffee_time
+    elif last_tea_time:
+        return "tea", last_tea_time
+    elif last_coffee_time:
+        return "coffee", last_coffee_time
+    else:
+        return None, None
+
+def epoch_bound(timestamp: datetime | None) -> int | None:
+    """
+    The first whole second not before timestamp, so for engines storing epoch
+    seconds ts >= since and ts < until select the same drinks as the datetimes
+    """
+    return math.ceil(timestamp.timestamp()) if timestamp else None
+
+def tag(drink_type: str, items):
+    for item in items:
+        yield item, drink_type
+
+def merge_drinks(timelines: dict):
+    """(item, drink type) in order, from a sorted timeline per drink type"""
+    # A function rather than a nested generator expression, which would
+    # look drink_type up late and label every item with the last one
+    return heapq.merge(*(tag(drink_type, items) for drink_type, items in timelines.items()))
+
+class Storage:
+    """Interface implemented by every storage engine"""
+
+    def init_user(self, username: str):
+        """Make sure the user exists, called before every write"""
+        raise NotImplementedError
+
+    def append(self, username: str, drink_type: str, timestamp: datetime):
+        """Record a drink"""
+        raise NotImplementedError
+
+    def append_many(self, events: list[tuple[str, str, datetime]]):
+        """Record a batch of (username, drink type, timestamp), oldest first"""
+        for username, drink_type, timestamp in events:
+            self.append(username, drink_type, timestamp)
+
+    def remove_last(self, username: str, drink_type: str) -> bool:
+        """Undo the user's most recent drink of this type, False if there was none"""
+        raise NotImplementedError
+
+    def last_drink(self, username: str) -> tuple:
+        """The user's most recent (drink type, timestamp), or (None, None)"""
+        raise NotImplementedError
+
+    def users(self) -> list[str]:
+        raise NotImplementedError
+
+    def user_counts(self, username: str) -> dict[str, int]:
+        raise NotImplementedError
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        """Tea and coffee counts for every user"""
+        return {user: self.user_counts(user) for user in self.users()}
+
+    def iter_events(self, username: str, since: datetime = None, until: datetime = None):
+        """
+        The user's drinks as (timestamp, drink type), oldest first, only those
+        in [since, until) if given.  Engines find the start of the range
+        rather than reading up to it.
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """Make everything written so far visible in the files returned by paths()"""
+        pass
+
+    def paths(self, username: str) -> list[str]:
+        """Files to commit after a change for this user"""
+        raise NotImplementedError
+
+def append_timestamp_to_file(filepath: Path, timestamp: datetime = None):
+    if timestamp is None:
+        timestamp = datetime.now(tz=UTC)
+    insert_timestamps_into_file(filepath, [timestamp])
+
+def find_insertion_point(f, timestamp: datetime) -> int:
+    """
+    Offset just after the last line of a sorted binary file that isn't later
+    than timestamp, reading backwards only as far as that line.
+    """
+    pos = f.seek(0, os.SEEK_END)
+    # The file from pos up to the lines already known to be later
+    buffer = b""
+    while True:
+        newline = buffer.rfind(b"\n", 0, len(buffer) - 1)
+        if newline == -1 and pos > 0:
+            size = min(TAIL_BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            buffer = f.read(size) + buffer
+            continue
+
+        line_start = newline + 1
+        line = buffer[line_start:]
+        if line.strip() and parse_timestamp(line.decode()) <= timestamp:
+            return pos + len(buffer)
+        buffer = buffer[:line_start]
+        if not buffer:
+            return pos
+
+def find_first_line_from(f, timestamp: datetime) -> int:
+    """
+    Offset of a line of a sorted binary file at or shortly before the first
+    one that isn't earlier than timestamp, by bisecting on byte offsets.  The
+    caller reads on from there and skips what is still too early.
+    """
+    low, high = 0, f.seek(0, os.SEEK_END)
+    # Every line starting before low is earlier than timestamp, and the first
+    # line starting after high isn't (or there is none)
+    while low < high:
+        middle = (low + high) // 2
+        f.seek(middle)
+        if middle > 0:
+            # To the start of the next line
+            f.readline()
+        line = f.readline()
+        while line and not line.strip():
+            line = f.readline()
+        if line and parse_timestamp(line.decode()) < timestamp:
+            low = f.tell()
+        else:
+            high = middle
+    return low
+
+def insert_timestamps_into_file(filepath: Path, timestamps: list[datetime]):
+    """
+    Add timestamps with one write and one fsync, keeping the file oldest
+    first.  Usually they are the newest and are simply appended; backfilled
+    ones are merged into the lines after them, and only those are rewritten.
+    """
+    timestamps = sorted(timestamps)
+    fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+b") as f:
+        start = find_insertion_point(f, timestamps[0])
+        f.seek(start)
+        later = [parse_timestamp(line.decode()) for line in f.read().splitlines() if line.strip()]
+        merged = heapq.merge(later, timestamps) if later else timestamps
+        f.seek(start)
+        f.write("".join(f"{format_timestamp(timestamp)}\n" for timestamp in merged).encode())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+def count_lines_in_file(filepath: Path) -> int:
+    if not filepath.exists():
+        return 0
+
+    with open(filepath, "r") as f:
+        return len([line for line in f if line.strip()])
+
+def find_last_line(f) -> tuple:
+    """
+    Read backwards from the end of a binary file in small blocks to find the
+    last non-empty line.  Returns (offset of the line, stripped line) or
+    (None, None), without reading more than the tail of the file.
+    """
+    pos = f.seek(0, os.SEEK_END)
+    buffer = b""
+    while pos > 0:
+        size = min(TAIL_BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        buffer = f.read(size) + buffer
+
+        stripped = buffer.rstrip()
+        newline = stripped.rfind(b"\n")
+        if stripped and newline != -1:
+            return pos + newline + 1, stripped[newline + 1:].strip()
+
+    stripped = buffer.strip()
+    if stripped:
+        return 0, stripped
+    return None, None
+
+def remove_last_line_from_file(filepath: Path) -> bool:
+    """Remove the last non-empty line from a file by truncating it in place"""
+    if not filepath.exists():
+        return False
+
+    with open(filepath, "r+b") as f:
+        offset, line = find_last_line(f)
+        if line is None:
+            return False
+        f.truncate(offset)
+        os.fsync(f.fileno())
+
+    return True
+
+def iter_timestamps(filepath: Path, since: datetime = None, until: datetime = None):
+    """The timestamps in [since, until) in a drink file, read one line at a time"""
+    if not filepath.exists():
+        return
+
+    with open(filepath, "rb") as f:
+        if since:
+            f.seek(find_first_line_from(f, since))
+        for line in f:
+            if not line.strip():
+                continue
+            timestamp = parse_timestamp(line.decode())
+            if since and timestamp < since:
+                continue
+            if until and timestamp >= until:
+                return
+            yield timestamp
+
+def read_last_timestamp(filepath: Path):
+    """The last timestamp in a drink file, or None"""
+    if not filepath.exists():
+        return None
+
+    with open(filepath, "rb") as f:
+        _, line = find_last_line(f)
+    if line is None:
+        return None
+    return parse_timestamp(line.decode())
+
+class TextStorage(Storage):
+    """data/<username>/<drink>.txt with one ISO timestamp per line"""
+
+    def __init__(self, root: Path = Path("data")):
+        self.root = Path(root)
+
+    def user_dir(self, username: str) -> Path:
+        return self.root / username
+
+    def drink_file(self, username: str, drink_type: str) -> Path:
+        return self.user_dir(username) / f"{drink_type}.txt"
+
+    def init_user(self, username: str):
+        user_dir = self.user_dir(username)
+        user_dir.mkdir(exist_ok=True, parents=True)
+
+        for drink_type in DRINKS:
+            drink_file = self.drink_file(username, drink_type)
+            if not drink_file.exists():
+                drink_file.touch()
+
+    def append(self, username: str, drink_type: str, timestamp: datetime):
+        append_timestamp_to_file(self.drink_file(username, drink_type), timestamp)
+
+    def append_many(self, events: list[tuple[str, str, datetime]]):
+        by_file = {}
+        for username, drink_type, timestamp in events:
+            by_file.setdefault((username, drink_type), []).append(timestamp)
+        for (username, drink_type), timestamps in by_file.items():
+            self.init_user(username)
+            insert_timestamps_into_file(self.drink_file(username, drink_type), timestamps)
+
+    def remove_last(self, username: str, drink_type: str) -> bool:
+        return remove_last_line_from_file(self.drink_file(username, drink_type))
+
+    def last_drink(self, username: str) -> tuple:
+        if not self.user_dir(username).exists():
+            return None, None
+        return latest_drink(
+            read_last_timestamp(self.drink_file(username, "tea")),
+            read_last_timestamp(self.drink_file(username, "coffee")),
+        )
+
+    def users(self) -> list[str]:
+        if not self.root.is_dir():
+            return []
+        return os.listdir(self.root)
+
+    def user_counts(self, username: str) -> dict[str, int]:
+        return {
+            drink_type: count_lines_in_file(self.drink_file(username, drink_type))
+            for drink_type in DRINKS
+        }
+
+    def iter_events(self, username: str, since: datetime = None, until: datetime = None):
+        return merge_drinks({
+            drink_type: iter_timestamps(self.drink_file(username, drink_type), since, until)
+            for drink_type in DRINKS
+        })
+
+    def paths(self, username: str) -> list[str]:
+        return [f"{self.user_dir(username)}/"]
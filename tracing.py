@@ -0,0 +1,72 @@
+"""
+Request tracing and structured logs.
+
+Each HTTP request gets a Trace holding its request id, kept in a context
+variable so it follows the request into asyncio.to_thread workers.  Stages of
+the request are timed with span(), which records them on the current trace
+(if there is one) and in the stage latency histogram of /metrics.  When the
+request finishes the whole trace is written as one JSON log line.
+
+log() replaces print for the server: one JSON object per line on stdout,
+tagged with the current request id.
+"""
+import json
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, UTC
+
+from metrics import STAGE_LATENCY
+
+current_trace: ContextVar["Trace | None"] = ContextVar("current_trace", default=None)
+output_lock = threading.Lock()
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+class Trace:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        # (name, start offset, duration) in seconds, appended from any thread
+        self.spans: list[tuple[str, float, float]] = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def span_fields(self) -> list[dict]:
+        return [
+            {"name": name, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+            for name, offset, duration in self.spans
+        ]
+
+def log(event: str, level: str = "info", **fields):
+    record = {
+        "time": datetime.now(UTC).isoformat(),
+        "level": level,
+        "event": event,
+    }
+    trace = current_trace.get()
+    if trace is not None:
+        record["request_id"] = trace.request_id
+    record.update(fields)
+    line = json.dumps(record, default=str)
+    with output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+@contextmanager
+def span(name: str):
+    """Time a stage of the current request, and of the stage histogram"""
+    trace = current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_LATENCY.observe(duration, stage=name)
+        if trace is not None:
+            trace.spans.append((name, start - trace.start, duration))